@@ -0,0 +1,456 @@
+from __future__ import annotations
+
+import logging
+from contextlib import nullcontext
+from time import time
+from typing import TYPE_CHECKING, ContextManager, Dict, Iterable, List, Sequence
+
+import polars as pl
+
+import inference
+from columnar import FrameInput, extract_variant_frame, to_frame
+from dedup import residual_text
+from main import (
+    RE2_MAX_MEM,
+    batch_address_match,
+    compile_variant_patterns,
+    extract_variant_batch,
+    log_pattern_report,
+    variant_matches_to_df,
+)
+from model import RawAddr, VariantMatch
+from prefilter import EMPTY, UNMATCHED, unresolvable_reason
+from prepare import (
+    SHORTEN_LEVELS,
+    address_table,
+    build_variant_index,
+    load_address_table,
+    load_reference_index,
+    normalize,
+    prepare_variants,
+)
+from profiling import Profiler
+from segment import (
+    OVERLAPS,
+    extract_token_batch,
+    resolve_overlaps,
+    token_width,
+    tokenize,
+)
+from trie import VariantTrie, extract_trie_batch
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+LEVELS = ["ward", "district", "province"]
+
+
+class AddressParser:
+    """
+    In-memory address parser. The variant index is prepared and compiled once,
+    on the first parse rather than at construction, so building a parser is
+    free for short-lived processes; `parse` and `parse_batch` only scan the
+    given addresses and never write files.
+
+    Example:
+        parser = AddressParser()
+        parser.parse("06 ngo 107 hong mai hbt hn")
+        parser.parse_batch(df["ADDR"])
+
+    `engine`, `max_mem`, `tail_segments`, `overlap` and `positions` select
+    the matcher, the re2 budget of its compiled programs, the overlapping hits
+    kept and the span unit of the scoring, `cascade`, `cascade_threshold` and
+    `calibration` the early exit and the confidence column, see
+    `main.process_address_index` and `inference.address_infer`. With
+    `history` (areas of replaced lists) and `code_map`, legacy addresses are
+    matched too and their results moved to the current codes, see
+    `reference.load_history`. `shorten` lists the levels indexed with the
+    abbreviated forms of their names when the index is built here (see
+    `prepare.prepare_variants`), the "trie" engine keeps the larger ward set
+    compact. With a `profiler`, stage times and sampled per-address costs are
+    recorded, see `profiling.Profiler`.
+
+    Every result carries the codes, names and canonical `address` of its
+    area, gathered from `prepare.address_table` once the best candidates are
+    known.
+
+    With `prefilter`, inputs that cannot hold an address (empty, punctuation,
+    phone number or fewer than `min_length` letters and digits) skip the
+    matching, their `reason` column tells why, see `prefilter.py`.
+    """
+
+    def __init__(
+        self,
+        official_areas: pl.DataFrame | None = None,
+        variant_index: pl.DataFrame | Dict[str, pl.DataFrame] | None = None,
+        weights: Dict[str, Dict[str, float]] = inference.DEFAULT_WEIGHTS,
+        batch_size: int = 5000,
+        reference_index: str | None = None,
+        engine: str = "regex",
+        max_mem: int = RE2_MAX_MEM,
+        tail_segments: int | None = None,
+        positions: str = "char",
+        overlap: str = "all",
+        shorten: Sequence[str] = SHORTEN_LEVELS,
+        cascade: bool = False,
+        cascade_threshold: float = 0.9,
+        calibration: Dict | None = inference.DEFAULT_CALIBRATION,
+        history: pl.DataFrame | None = None,
+        code_map: pl.DataFrame | None = None,
+        profiler: Profiler | None = None,
+        prefilter: bool = True,
+        min_length: int = 2,
+    ):
+        if engine not in ("regex", "token", "trie"):
+            raise ValueError(f"Unknown engine: {engine}")
+        if overlap not in OVERLAPS:
+            raise ValueError(f"Unknown overlap policy: {overlap}")
+
+        self.official_areas = official_areas
+        self.indexes = variant_index
+        self.weights = weights
+        self.batch_size = batch_size
+        self.reference_index = reference_index
+        self.engine = engine
+        self.max_mem = max_mem
+        self.tail_segments = tail_segments
+        self.positions = positions
+        self.overlap = overlap
+        self.shorten = shorten
+        self.cascade = cascade
+        self.cascade_threshold = cascade_threshold
+        self.calibration = calibration
+        self.history = history
+        self.code_map = code_map
+        self.profiler = profiler
+        self.prefilter = prefilter
+        self.min_length = min_length
+        # official areas plus the history, the ones matched and scored
+        self.areas: pl.DataFrame | None = None
+        # `prepare.address_table` of the areas and of the current list only
+        self.addresses: pl.DataFrame | None = None
+        self.current_addresses: pl.DataFrame | None = None
+        # codes, parents and strategy areas of the addresses, see
+        # `inference.area_lookups`
+        self.area_lookups: Dict[str, pl.DataFrame] = {}
+
+        self.lookups: Dict[str, Dict[str, int]] = {}
+        self.patterns = {}
+        self.widths: Dict[str, int] = {}
+        self.tries: Dict[str, VariantTrie] = {}
+
+    @classmethod
+    def from_reference_index(
+        cls, directory: str = "./dataset/reference_index", **kwargs
+    ) -> "AddressParser":
+        """
+        Builds a parser over the memory-mapped files written by
+        `prepare.save_reference_index`, shared by every process mapping them.
+        """
+        return cls(reference_index=directory, **kwargs)
+
+    def load(self) -> "AddressParser":
+        if self.lookups or self.tries:
+            return self
+
+        start = time()
+        if self.reference_index is not None:
+            self.official_areas, self.indexes = load_reference_index(
+                self.reference_index
+            )
+        if self.official_areas is None:
+            self.official_areas = pl.read_parquet(
+                "./dataset/param_c06_distilled.parquet"
+            )
+        self.areas = self.official_areas
+        if self.history is not None and not self.history.is_empty():
+            self.areas = pl.concat(
+                [self.official_areas, self.history.select(self.official_areas.columns)]
+            )
+            # a shared index only holds the current list
+            self.indexes = None
+        if self.reference_index is not None and self.areas is self.official_areas:
+            self.addresses = load_address_table(self.reference_index)
+        else:
+            self.addresses = address_table(self.areas)
+        self.current_addresses = (
+            self.addresses
+            if self.areas is self.official_areas
+            else address_table(self.official_areas)
+        )
+        self.area_lookups = inference.area_lookups(self.addresses)
+        if self.indexes is None:
+            self.indexes = build_variant_index(
+                prepare_variants(self.areas, self.shorten)
+            )
+        if isinstance(self.indexes, pl.DataFrame):
+            self.indexes = {
+                level: self.indexes.filter(pl.col("level").eq(level))
+                for level in LEVELS
+            }
+
+        # only the variant -> row lookups, the compiled patterns and the tries
+        # are private to this process, the codes stay in the index frames
+        for level in LEVELS:
+            if self.engine == "trie":
+                self.tries[level] = VariantTrie(self.indexes[level]["variant"])
+                continue
+            self.lookups[level] = {
+                variant: row
+                for row, variant in enumerate(self.indexes[level]["variant"])
+            }
+            if self.engine == "regex":
+                self.patterns[level] = compile_variant_patterns(
+                    list(self.lookups[level]), self.max_mem
+                )
+                log_pattern_report(level, self.patterns[level])
+            else:
+                self.widths[level] = token_width(self.lookups[level])
+
+        logging.info(f"address parser ready in {(time() - start)}seconds")
+
+        return self
+
+    def stage(self, name: str) -> ContextManager:
+        return nullcontext() if self.profiler is None else self.profiler.stage(name)
+
+    def match(self, addrs: List[RawAddr]) -> Dict[str, pl.DataFrame]:
+        with self.stage("load"):
+            self.load()
+        if self.engine == "regex":
+            batchs = batch_address_match(
+                addrs=addrs, batch_size=self.batch_size, progress=False
+            )
+        else:
+            tokens = [tokenize(addr.content) for addr in addrs]
+
+        matches = {}
+        for level in LEVELS:
+            results: List[VariantMatch] = []
+            with self.stage(level):
+                if self.engine == "regex":
+                    for batch in batchs:
+                        results.extend(
+                            extract_variant_batch(
+                                batch=batch,
+                                patterns=self.patterns[level],
+                                lookup=self.lookups[level],
+                            )
+                        )
+                elif self.engine == "trie":
+                    results = extract_trie_batch(
+                        addrs=addrs,
+                        tokens=tokens,
+                        trie=self.tries[level],
+                        tail_segments=self.tail_segments,
+                    )
+                else:
+                    results = extract_token_batch(
+                        addrs=addrs,
+                        tokens=tokens,
+                        lookup=self.lookups[level],
+                        width=self.widths[level],
+                        tail_segments=self.tail_segments,
+                    )
+                matches[level] = variant_matches_to_df(
+                    resolve_overlaps(results, self.overlap),
+                    level,
+                    self.indexes[level],
+                )
+
+        return matches
+
+    def match_frame(self, inputs: pl.DataFrame) -> Dict[str, pl.DataFrame]:
+        """
+        `match` for the (index, addr) rows of `inputs`. When every hit is kept,
+        the regex engine scans the Arrow buffers of the addresses in place
+        (see `columnar.extract_variant_frame`), the other paths go through
+        `RawAddr` objects.
+        """
+        if self.engine != "regex" or self.overlap != "all":
+            return self.match(
+                [
+                    RawAddr(index=index, content=content)
+                    for index, content in inputs.select("index", "addr").iter_rows()
+                ]
+            )
+
+        with self.stage("load"):
+            self.load()
+        matches = {}
+        for level in LEVELS:
+            with self.stage(level):
+                matches[level] = extract_variant_frame(
+                    inputs,
+                    self.patterns[level],
+                    self.lookups[level],
+                    level,
+                    self.indexes[level],
+                    self.batch_size,
+                )
+
+        return matches
+
+    def resolve(self, inputs: pl.DataFrame) -> pl.DataFrame:
+        """Best candidate of every (index, addr) row that has one."""
+        with self.stage("match"):
+            matches = self.match_frame(inputs)
+        with self.stage("resolve"):
+            wards, districts, provinces = inference.resolve_candidates(
+                official_areas=self.areas,
+                match_wards_df=matches["ward"],
+                match_districts_df=matches["district"],
+                match_provinces_df=matches["province"],
+                lookups=self.area_lookups,
+            )
+        with self.stage("features"):
+            if self.cascade:
+                features = inference.cascade_features(
+                    self.area_lookups,
+                    wards,
+                    districts,
+                    provinces,
+                    weights=self.weights,
+                    calibration=self.calibration,
+                    threshold=self.cascade_threshold,
+                    positions=self.positions,
+                )
+            else:
+                features = inference.candidate_features(
+                    self.area_lookups,
+                    wards,
+                    districts,
+                    provinces,
+                    positions=self.positions,
+                )
+        with self.stage("rescore"):
+            result = inference.attach_addresses(
+                inference.rescore(features, self.weights, self.calibration),
+                self.addresses,
+            )
+            result = result.join(
+                residual_text(result), on="index", how="left", maintain_order="left"
+            ).drop("addr", *inference.SPAN_COLUMNS)
+            if self.code_map is not None:
+                result = inference.remap_codes(
+                    result, self.code_map, self.current_addresses
+                )
+
+        if self.profiler is not None:
+            with self.stage("profile"):
+                self.profile_addresses(inputs, matches, features)
+
+        return result
+
+    def profile_addresses(
+        self,
+        inputs: pl.DataFrame,
+        matches: Dict[str, pl.DataFrame],
+        features: pl.DataFrame,
+    ):
+        """
+        Records the hit and candidate counts of the addresses picked by the
+        profiler and their share of the time of the batch: the matching time
+        split by characters, the resolve time by hits, and the features and
+        rescore time by candidates.
+        """
+        profiler = self.profiler
+        matching = sum(profiler.elapsed.get(level, 0.0) for level in LEVELS)
+        resolving = profiler.elapsed.get("resolve", 0.0)
+        scoring = profiler.elapsed.get("features", 0.0) + profiler.elapsed.get(
+            "rescore", 0.0
+        )
+
+        def share(work: pl.Expr) -> pl.Expr:
+            return work / work.sum().clip(1)
+
+        costs = (
+            inputs.select("index", "addr")
+            .join(
+                pl.concat([df.select("index") for df in matches.values()])
+                .group_by("index")
+                .len("hits"),
+                on="index",
+                how="left",
+            )
+            .join(features.group_by("index").len("candidates"), on="index", how="left")
+            .with_columns(pl.col("hits", "candidates").fill_null(0))
+            .with_columns(
+                (
+                    matching * share(pl.col("addr").str.len_chars())
+                    + resolving * share(pl.col("hits"))
+                    + scoring * share(pl.col("candidates"))
+                ).alias("seconds")
+            )
+        )
+
+        profiler.record(profiler.to_record(costs))
+
+    def parse_batch(self, addrs: Iterable[str] | pl.Series) -> pl.DataFrame:
+        """
+        Parses every address and returns one row per input, in input order,
+        with null codes and a `reason` for addresses that could not be
+        resolved.
+        """
+        inputs = normalize(
+            pl.DataFrame({"addr": pl.Series(addrs, dtype=pl.String)})
+        ).with_row_index("index")
+        empty = pl.col("addr").is_null() | pl.col("addr").str.len_chars().eq(0)
+        with self.stage("prefilter"):
+            inputs = inputs.with_columns(
+                pl.col("index").cast(pl.Int64),
+                unresolvable_reason("addr", self.min_length)
+                if self.prefilter
+                else pl.when(empty).then(pl.lit(EMPTY)).alias("reason"),
+            )
+
+        to_resolve = inputs.filter(pl.col("reason").is_null()).select("index", "addr")
+
+        if not to_resolve.is_empty():
+            with self.stage("parse"):
+                result = self.resolve(to_resolve)
+        else:
+            result = pl.DataFrame(
+                schema={
+                    "index": pl.Int64,
+                    **{
+                        col: pl.String
+                        for col in inference.AREA_COLUMNS
+                        if col not in ("index", "addr")
+                    },
+                    "score": pl.Float64,
+                    "confidence": pl.Float64,
+                    "residual": pl.String,
+                    **({} if self.code_map is None else {"remapped": pl.Boolean}),
+                }
+            )
+
+        unmatched = pl.when(pl.col("score").is_null()).then(pl.lit(UNMATCHED))
+
+        return (
+            inputs.join(result, on="index", how="left", maintain_order="left")
+            .with_columns(pl.col("reason").fill_null(unmatched))
+            .select(pl.all().exclude("reason"), pl.col("reason"))
+        )
+
+    def parse_arrow(
+        self, data: FrameInput, id_column: str = "ID", addr_column: str = "ADDR"
+    ) -> pa.Table:
+        """
+        `parse_batch` for columnar data: a pyarrow RecordBatch or Table, a
+        polars frame with `id_column` and `addr_column`, or a bare column of
+        addresses, read without a Python object per row. Returns an Arrow
+        table over the buffers of the result, keyed by `id_column` when the
+        input has one.
+        """
+        df = to_frame(data, addr_column)
+        result = self.parse_batch(df[addr_column])
+        if id_column in df.columns:
+            result = result.select(df[id_column], pl.all().exclude("index"))
+
+        # string views are the layout polars holds, the newest level hands
+        # them over as they are instead of rebuilding large strings
+        return result.to_arrow(compat_level=pl.CompatLevel.newest())
+
+    def parse(self, addr: str) -> dict:
+        return self.parse_batch([addr]).drop("index").row(0, named=True)
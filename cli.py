@@ -0,0 +1,349 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from time import time
+from typing import Iterator, Tuple
+
+import polars as pl
+
+import inference
+from address_parser import AddressParser
+from export import ExcelStream
+from main import RE2_MAX_MEM
+from prepare import SHORTEN_LEVELS, save_reference_index
+from profiling import Profiler, merge_profiles, profile_prefixes
+from segment import OVERLAPS
+
+parser: AddressParser | None = None
+
+
+def detect_format(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    match ext:
+        case ".xlsx" | ".xls":
+            return "excel"
+        case ".csv":
+            return "csv"
+        case ".parquet":
+            return "parquet"
+        case _:
+            raise ValueError(f"Cannot detect the format of {path}, use --format")
+
+
+def scan_input(path: str, fmt: str) -> pl.LazyFrame:
+    """Lazy csv/parquet input, Excel files cannot be scanned."""
+    match fmt:
+        case "csv":
+            return pl.scan_csv(path, infer_schema=False)
+        case "parquet":
+            return pl.scan_parquet(path)
+        case _:
+            raise ValueError(f"Unsupported format: {fmt}")
+
+
+def read_chunks(
+    path: str, fmt: str, chunk_size: int, columns: Tuple[str, str]
+) -> Iterator[Tuple[int, pl.DataFrame]]:
+    """Yields (chunk number, chunk) without loading csv/parquet inputs whole."""
+    if fmt == "excel":
+        df = pl.read_excel(path).select(pl.col(columns))
+        for i, chunk in enumerate(df.iter_slices(chunk_size)):
+            yield i, chunk
+        return
+
+    lf = scan_input(path, fmt).select(pl.col(columns))
+    total = lf.select(pl.len()).collect().item()
+    for i, offset in enumerate(range(0, total, chunk_size)):
+        yield i, lf.slice(offset, chunk_size).collect()
+
+
+def chunk_path(checkpoint_dir: str, i: int) -> str:
+    return os.path.join(checkpoint_dir, f"chunk-{i:06d}.parquet")
+
+
+def init_worker(
+    index_dir: str | None = None,
+    options: dict | None = None,
+    profile_rate: float | None = None,
+):
+    global parser
+    options = options or {}
+    if profile_rate is not None:
+        options = {**options, "profiler": Profiler(sample_rate=profile_rate)}
+    parser = (
+        AddressParser(**options)
+        if index_dir is None
+        else AddressParser.from_reference_index(index_dir, **options)
+    )
+
+
+def process_chunk(
+    i: int, chunk: pl.DataFrame, columns: Tuple[str, str], checkpoint_dir: str
+) -> int:
+    global parser
+    if parser is None:
+        init_worker()
+
+    id_column, addr_column = columns
+    result = parser.parse_batch(chunk[addr_column]).select(
+        chunk[id_column].alias(id_column), pl.all().exclude("index")
+    )
+
+    if parser.profiler is not None:
+        parser.profiler.dump(os.path.join(checkpoint_dir, "profile", f"chunk-{i:06d}"))
+        parser.profiler.reset()
+
+    # write then rename, so a killed job never leaves a partial checkpoint
+    path = chunk_path(checkpoint_dir, i)
+    result.write_parquet(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+    return i
+
+
+def check_manifest(checkpoint_dir: str, manifest: dict):
+    path = os.path.join(checkpoint_dir, "manifest.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            previous = json.load(f)
+        if previous != manifest:
+            raise ValueError(
+                f"{checkpoint_dir} holds checkpoints of another job: {previous}"
+            )
+    else:
+        with open(path, "w") as f:
+            json.dump(manifest, f)
+
+
+def merge_chunks(checkpoint_dir: str, output: str):
+    chunks = pl.scan_parquet(os.path.join(checkpoint_dir, "chunk-*.parquet"))
+    if output.endswith(".parquet"):
+        chunks.sink_parquet(output)
+    else:
+        chunks.sink_csv(output, separator=";")
+
+
+def stream_chunks(checkpoint_dir: str, stream: ExcelStream, next_chunk: int) -> int:
+    """
+    Queues the finished chunks from `next_chunk` on, in order, up to the first
+    one still running, and returns the number of the next chunk to write.
+    """
+    while os.path.exists(path := chunk_path(checkpoint_dir, next_chunk)):
+        stream.write(pl.read_parquet(path))
+        next_chunk += 1
+    return next_chunk
+
+
+def add_parser_arguments(arg_parser: argparse.ArgumentParser):
+    """Arguments of the `AddressParser` options, see `parser_options`."""
+    arg_parser.add_argument(
+        "--engine", choices=["regex", "token", "trie"], default="regex"
+    )
+    arg_parser.add_argument(
+        "--max-mem",
+        type=int,
+        default=RE2_MAX_MEM >> 20,
+        help="regex engine only: memory budget in MB of each compiled re2 "
+        "program, the variants are split over as many programs as needed",
+    )
+    arg_parser.add_argument(
+        "--tail-segments",
+        type=int,
+        help="token and trie engines only: match in the last comma/dash/semicolon "
+        "separated segments of each address",
+    )
+    arg_parser.add_argument(
+        "--overlap",
+        choices=list(OVERLAPS),
+        default="all",
+        help="overlapping hits of a level to keep: all, only the maximal spans, "
+        "or a leftmost-longest tiling of the address",
+    )
+    arg_parser.add_argument(
+        "--shorten-wards",
+        action="store_true",
+        help="also index the abbreviated ward names (initials, truncated "
+        "words), best with the trie engine",
+    )
+    arg_parser.add_argument(
+        "--positions",
+        choices=["char", "token"],
+        default="char",
+        help="unit of the span lengths and gaps used for scoring",
+    )
+    arg_parser.add_argument(
+        "--cascade",
+        action="store_true",
+        help="skip the fallback strategies for addresses the full hierarchy "
+        "already resolves confidently",
+    )
+    arg_parser.add_argument("--cascade-threshold", type=float, default=0.9)
+    arg_parser.add_argument(
+        "--calibration", help="JSON confidence calibration from evaluate.py"
+    )
+    arg_parser.add_argument(
+        "--no-prefilter",
+        action="store_true",
+        help="match empty-looking, phone-only and very short inputs too "
+        "instead of flagging them in the reason column",
+    )
+    arg_parser.add_argument(
+        "--min-length",
+        type=int,
+        default=2,
+        help="inputs with fewer letters and digits are not matched",
+    )
+
+
+def parser_options(args: argparse.Namespace) -> dict:
+    """`AddressParser` keyword arguments, JSON-serializable for manifests."""
+    return {
+        "engine": args.engine,
+        "max_mem": args.max_mem << 20,
+        "tail_segments": args.tail_segments,
+        "positions": args.positions,
+        "overlap": args.overlap,
+        # a list, so the manifest compares equal once read back from JSON
+        "shorten": ["ward", *SHORTEN_LEVELS]
+        if args.shorten_wards
+        else list(SHORTEN_LEVELS),
+        "cascade": args.cascade,
+        "cascade_threshold": args.cascade_threshold,
+        "calibration": None
+        if args.calibration is None
+        else inference.load_calibration(args.calibration),
+        "prefilter": not args.no_prefilter,
+        "min_length": args.min_length,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Standardize a file of raw addresses in resumable chunks."
+    )
+    arg_parser.add_argument("--input", required=True)
+    arg_parser.add_argument(
+        "--format", choices=["excel", "csv", "parquet"], help="default: from extension"
+    )
+    arg_parser.add_argument(
+        "--output",
+        default="test.csv",
+        help="csv, parquet or xlsx, the latter written while the chunks are "
+        "processed and split over sheets past the Excel row limit",
+    )
+    arg_parser.add_argument("--chunk-size", type=int, default=100_000)
+    arg_parser.add_argument("--workers", type=int, default=1)
+    arg_parser.add_argument(
+        "--checkpoint-dir", help="default: <output>.checkpoints next to the output"
+    )
+    arg_parser.add_argument(
+        "--index",
+        help="reference index directory shared by the workers through memory "
+        "mapping, built on first use",
+    )
+    add_parser_arguments(arg_parser)
+    arg_parser.add_argument(
+        "--profile",
+        help="directory for the stage times (stages.folded) and the most "
+        "expensive addresses (top.csv) of this run",
+    )
+    arg_parser.add_argument(
+        "--profile-rate",
+        type=float,
+        default=0.01,
+        help="share of the addresses whose cost is recorded when profiling",
+    )
+    arg_parser.add_argument("--id-column", default="ID")
+    arg_parser.add_argument("--addr-column", default="ADDR")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level="INFO")
+
+    start = time()
+    fmt = args.format or detect_format(args.input)
+    columns = (args.id_column, args.addr_column)
+    options = parser_options(args)
+    checkpoint_dir = args.checkpoint_dir or f"{args.output}.checkpoints"
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    check_manifest(
+        checkpoint_dir,
+        {
+            "input": os.path.abspath(args.input),
+            "chunk_size": args.chunk_size,
+            "columns": list(columns),
+            "parser": options,
+        },
+    )
+
+    profile_rate = None if args.profile is None else args.profile_rate
+
+    if args.index is not None and not os.path.exists(args.index):
+        save_reference_index(args.index, shorten=options["shorten"])
+
+    def pending() -> Iterator[Tuple[int, pl.DataFrame]]:
+        for i, chunk in read_chunks(args.input, fmt, args.chunk_size, columns):
+            if os.path.exists(chunk_path(checkpoint_dir, i)):
+                logging.info(f"chunk {i} already done, skipping")
+                continue
+            yield i, chunk
+
+    # Excel output cannot be merged lazily like csv/parquet, so the chunks are
+    # streamed to it in order as soon as they are done
+    excel = ExcelStream(args.output) if args.output.endswith(".xlsx") else None
+    written = 0
+
+    def finished(i: int):
+        nonlocal written
+        logging.info(f"chunk {i} done")
+        if excel is not None:
+            written = stream_chunks(checkpoint_dir, excel, written)
+
+    if args.workers > 1:
+        # keep a bounded number of chunks in flight so huge inputs are never
+        # read into memory all at once
+        # polars' thread pool does not survive fork, so workers are spawned
+        with ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(args.index, options, profile_rate),
+        ) as pool:
+            in_flight = set()
+            for i, chunk in pending():
+                if len(in_flight) >= 2 * args.workers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finished(future.result())
+                in_flight.add(
+                    pool.submit(process_chunk, i, chunk, columns, checkpoint_dir)
+                )
+            for future in as_completed(in_flight):
+                finished(future.result())
+    else:
+        init_worker(args.index, options, profile_rate)
+        for i, chunk in pending():
+            finished(process_chunk(i, chunk, columns, checkpoint_dir))
+
+    if excel is not None:
+        stream_chunks(checkpoint_dir, excel, written)
+        excel.close()
+    else:
+        merge_chunks(checkpoint_dir, args.output)
+    if args.profile is not None:
+        merge_profiles(
+            profile_prefixes(os.path.join(checkpoint_dir, "profile")), args.profile
+        )
+
+    logging.info(f"Take {(time() - start)}seconds")
+
+
+if __name__ == "__main__":
+    main()
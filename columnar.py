@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import bisect
+from typing import TYPE_CHECKING, Dict, List, Sequence, Tuple, Union
+
+import polars as pl
+
+from segment import token_positions
+
+# pyarrow and re2 are only imported by the functions using them, callers that
+# never hand over Arrow data do not pay for them at import time
+if TYPE_CHECKING:
+    import pyarrow as pa
+    import re2
+
+# what `to_frame` accepts
+ArrowInput = Union["pa.RecordBatch", "pa.Table", "pa.Array", "pa.ChunkedArray"]
+FrameInput = Union[ArrowInput, pl.DataFrame, pl.Series]
+
+
+def to_frame(data: FrameInput, addr_column: str = "ADDR") -> pl.DataFrame:
+    """
+    `data` as a polars frame, converted column by column rather than row by
+    row: a pyarrow RecordBatch or Table, a polars DataFrame, or a bare
+    column of addresses (pyarrow Array or polars Series) named `addr_column`.
+    """
+    match data:
+        case pl.DataFrame():
+            return data
+        case pl.Series():
+            return data.alias(addr_column).to_frame()
+
+    import pyarrow as pa
+
+    match data:
+        case pa.RecordBatch() | pa.Table():
+            return pl.from_arrow(data)
+        case pa.Array() | pa.ChunkedArray():
+            return pl.from_arrow(data).alias(addr_column).to_frame()
+        case _:
+            raise TypeError(f"Cannot read addresses from {type(data).__name__}")
+
+
+def addr_buffer(addrs: pl.Series) -> Tuple[memoryview, memoryview]:
+    """
+    The utf-8 data buffer of `addrs`, every address followed by ";" so no
+    variant matches across two of them, and the int64 byte offsets of the
+    addresses in it, as built by Arrow: one buffer per batch, scanned as is.
+    """
+    import pyarrow as pa
+
+    array = (
+        (addrs + ";")
+        .rechunk()
+        .to_arrow(compat_level=pl.CompatLevel.oldest())
+        .cast(pa.large_string())
+    )
+    _, offsets, data = array.buffers()
+    offsets = memoryview(offsets).cast("q")[
+        array.offset : array.offset + len(array) + 1
+    ]
+    return memoryview(data), offsets
+
+
+def scan_variant_buffer(
+    data: memoryview,
+    offsets: Sequence[int],
+    patterns: Sequence[re2._Regexp],
+    lookup: Dict[str, int],
+    multibyte: Sequence[int] = (),
+) -> Dict[str, List[int]]:
+    """
+    Hits of `patterns` in an `addr_buffer`, as columns: the position of the
+    address in the buffer, the variant row in `lookup` and the character
+    span, end included. Same hits as `main.extract_variant_batch`, only the
+    `multibyte` addresses (non-ascii, by position) are decoded to turn byte
+    positions into characters.
+    """
+    multibyte = set(multibyte)
+
+    def to_char_idx(i: int, byte_idx: int) -> int:
+        if i not in multibyte:
+            return byte_idx
+        start = offsets[i]
+        return len(bytes(data[start : start + byte_idx]).decode(errors="ignore"))
+
+    # keep the longest hit per (address, start, word count), see
+    # `main.extract_variant_batch`
+    longest: Dict[Tuple[int, int, int], Tuple[int, str]] = {}
+    for pattern in patterns:
+        match_object = pattern.search(data, offsets[0], offsets[-1])
+        while match_object is not None:
+            # every accessor of a re2 match rebuilds its spans, read them once
+            start, end = match_object.span()
+            i = bisect.bisect_right(offsets, start) - 1
+            start_idx = start - offsets[i]
+            end_idx = end - offsets[i]
+
+            variant = bytes(data[start:end]).decode().lower()
+            key = (i, start_idx, variant.count(" "))
+            if (
+                end_idx < offsets[i + 1] - offsets[i]
+                and end_idx > longest.get(key, (-1,))[0]
+            ):
+                longest[key] = (end_idx, variant)
+            match_object = pattern.search(data, start + 1, offsets[-1])
+
+    columns: Dict[str, List[int]] = {
+        "position": [],
+        "row": [],
+        "start_idx": [],
+        "end_idx": [],
+    }
+    for (i, start_idx, _), (end_idx, variant) in longest.items():
+        columns["position"].append(i)
+        columns["row"].append(lookup[variant])
+        columns["start_idx"].append(to_char_idx(i, start_idx))
+        columns["end_idx"].append(to_char_idx(i, end_idx) - 1)
+
+    return columns
+
+
+def extract_variant_frame(
+    inputs: pl.DataFrame,
+    patterns: Sequence[re2._Regexp],
+    lookup: Dict[str, int],
+    level: str,
+    level_index: pl.DataFrame,
+    batch_size: int = 5000,
+) -> pl.DataFrame:
+    """
+    Columnar counterpart of `main.extract_variant_batch` plus
+    `main.variant_matches_to_df` for the (index, addr) rows of `inputs`:
+    every batch of `batch_size` addresses is scanned in its Arrow buffer and
+    the hits are gathered back to their addresses and candidate codes, with
+    no Python object per address.
+    """
+    frames = []
+    for batch in inputs.iter_slices(batch_size):
+        data, offsets = addr_buffer(batch["addr"])
+        addrs = batch["addr"]
+        multibyte = (addrs.str.len_bytes() != addrs.str.len_chars()).arg_true()
+        hits = pl.DataFrame(
+            scan_variant_buffer(data, offsets, patterns, lookup, multibyte.to_list()),
+            schema={
+                "position": pl.UInt32,
+                "row": pl.UInt32,
+                "start_idx": pl.Int64,
+                "end_idx": pl.Int64,
+            },
+        )
+        frames.append(
+            hits.select(
+                batch["index"].gather(hits["position"]).cast(pl.Int64),
+                addrs.gather(hits["position"]),
+                level_index["variant"].gather(hits["row"]),
+                level_index["codes"].gather(hits["row"]).alias(f"{level} codes"),
+                level_index["ambiguity"].gather(hits["row"]).cast(pl.Int64),
+                pl.col("start_idx", "end_idx"),
+            )
+        )
+
+    schema = {
+        "index": pl.Int64,
+        "addr": pl.String,
+        "variant": pl.String,
+        f"{level} codes": pl.List(pl.String),
+        "ambiguity": pl.Int64,
+        "start_idx": pl.Int64,
+        "end_idx": pl.Int64,
+    }
+    return pl.concat([pl.DataFrame(schema=schema), *frames]).with_columns(
+        token_positions()
+    )
@@ -0,0 +1,226 @@
+import argparse
+import logging
+from time import time
+
+import polars as pl
+
+from prepare import remove_accents_expr
+
+LEVELS = ["ward", "district", "province"]
+
+# words that only say what kind of place follows, not which one
+FILLER_WORDS = [
+    "so",
+    "nha",
+    "duong",
+    "pho",
+    "ngo",
+    "ngach",
+    "hem",
+    "kiet",
+    "to",
+    "khu",
+    "thon",
+    "xom",
+    "ap",
+    "viet",
+    "nam",
+    "vn",
+]
+
+
+def residual_text(result: pl.DataFrame) -> pl.DataFrame:
+    """
+    (index, residual) of every row of `result`: its `addr` without the spans
+    of the hits its ward, district and province were resolved from
+    (`start_idx_<level>` and `end_idx_<level>`, see
+    `inference.strategy_features`), unaccented and without punctuation, e.g.
+    "so 12 ngo 5" for "số 12, ngõ 5, p. phúc xá, ba đình, hà nội". Other
+    occurrences of the same names or numbers, like a house number equal to a
+    numeric ward, are kept.
+    """
+    spans = pl.concat(
+        [
+            result.select(
+                pl.col("index"),
+                pl.col(f"start_idx_{level}").alias("start_idx"),
+                pl.col(f"end_idx_{level}").alias("end_idx"),
+            ).drop_nulls()
+            for level in LEVELS
+        ]
+        # an empty span at the end of every address closes its last piece
+        + [
+            result.select(
+                pl.col("index"),
+                pl.col("addr").str.len_chars().cast(pl.Int64).alias("start_idx"),
+                (pl.col("addr").str.len_chars().cast(pl.Int64) - 1).alias("end_idx"),
+            )
+        ]
+    )
+
+    # every piece runs from the furthest end of the spans before it to the
+    # start of the next one, overlapping spans leave empty pieces
+    after = pl.col("end_idx").cum_max().shift(1).over("index").fill_null(-1) + 1
+    pieces = (
+        spans.sort("index", "start_idx", "end_idx")
+        .with_columns(after.alias("from"))
+        .join(result.select("index", "addr"), on="index", how="inner")
+        .select(
+            pl.col("index"),
+            pl.col("addr").str.slice(
+                pl.col("from"), (pl.col("start_idx") - pl.col("from")).clip(0)
+            ),
+        )
+    )
+
+    return pieces.group_by("index", maintain_order=True).agg(
+        remove_accents_expr(pl.col("addr").str.join(" "))
+        .str.to_lowercase()
+        .str.replace_all(r"[^a-z0-9]+", " ")
+        .str.strip_chars()
+        .alias("residual")
+    )
+
+
+def connected_components(edges: pl.DataFrame) -> pl.DataFrame:
+    """
+    (id, cluster) of every id of the (id, id_other) `edges`, where cluster is
+    the smallest id connected to it, by propagating the smallest label along
+    the edges until none changes.
+    """
+    both = pl.concat(
+        [
+            edges.select("id", "id_other"),
+            edges.select(
+                pl.col("id_other").alias("id"), pl.col("id").alias("id_other")
+            ),
+        ]
+    )
+    labels = both.select(pl.col("id").unique()).with_columns(
+        pl.col("id").alias("cluster")
+    )
+
+    while True:
+        proposed = both.join(labels, left_on="id_other", right_on="id").select(
+            "id", "cluster"
+        )
+        updated = (
+            pl.concat([labels, proposed]).group_by("id").agg(pl.col("cluster").min())
+        )
+        changed = updated.join(labels, on="id").filter(
+            pl.col("cluster") != pl.col("cluster_right")
+        )
+        labels = updated
+        if changed.is_empty():
+            return labels
+
+
+def cluster_duplicates(
+    results: pl.DataFrame,
+    id_column: str = "index",
+    threshold: float = 0.5,
+    max_block: int = 1000,
+) -> pl.DataFrame:
+    """
+    `results` with a `cluster` column, the smallest `id_column` of each group
+    of duplicate addresses. Rows are only compared within a block, the rows
+    sharing a `ward code` and the house numbers of their `residual` (see
+    `residual_text`), and linked when the Jaccard similarity of their other
+    residual words, fillers like "so" or "ngo" aside, reaches `threshold`.
+    Identical words are linked without comparing them, and blocks with more
+    than `max_block` distinct words only link identical ones, so the work
+    stays near-linear in the number of rows. Rows without a ward code are
+    their own cluster.
+    """
+    if "residual" not in results.columns:
+        raise ValueError("results need a residual column, see dedup.residual_text")
+
+    word = pl.element()
+    rows = results.filter(
+        pl.col("ward code").is_not_null() & pl.col("residual").is_not_null()
+    ).select(
+        pl.col(id_column).alias("id"),
+        pl.col("ward code"),
+        pl.col("residual")
+        .str.extract_all(r"[0-9]+")
+        .list.unique()
+        .list.sort()
+        .list.join(" ")
+        .alias("numbers"),
+        pl.col("residual")
+        .str.split(" ")
+        .list.eval(
+            word.filter(
+                ~word.str.contains(r"[0-9]") & ~word.is_in(FILLER_WORDS) & word.ne("")
+            )
+        )
+        .list.unique()
+        .list.sort()
+        .alias("words"),
+    )
+
+    # identical words are linked to the first of them up front, only the
+    # distinct ones of a block are compared pair by pair
+    block = ["ward code", "numbers"]
+    rows = rows.with_columns(pl.col("id").min().over(*block, "words").alias("first"))
+    identical = rows.filter(pl.col("id") != pl.col("first")).select(
+        pl.col("id"), pl.col("first").alias("id_other")
+    )
+    distinct = rows.filter(pl.col("id") == pl.col("first")).drop("first")
+    small = distinct.filter(pl.len().over(block) <= max_block)
+
+    union = pl.col("words").list.set_union("words_other").list.len()
+    common = pl.col("words").list.set_intersection("words_other").list.len()
+    similar = (
+        small.join(small, on=block, suffix="_other")
+        .filter(pl.col("id") < pl.col("id_other"))
+        .filter(pl.when(union == 0).then(1.0).otherwise(common / union) >= threshold)
+        .select("id", "id_other")
+    )
+
+    clusters = connected_components(pl.concat([similar, identical]))
+    logging.info(
+        f"{clusters.height} of {results.height} rows in "
+        f"{clusters['cluster'].n_unique()} clusters of duplicates"
+    )
+
+    return results.join(
+        clusters.rename({"id": id_column}),
+        on=id_column,
+        how="left",
+        maintain_order="left",
+    ).with_columns(pl.col("cluster").fill_null(pl.col(id_column)))
+
+
+def main():
+    from reference import read_results, write_results
+
+    arg_parser = argparse.ArgumentParser(
+        description="Cluster the duplicate addresses of a result file."
+    )
+    arg_parser.add_argument("--input", required=True, help="cli.py result file")
+    arg_parser.add_argument("--output", required=True)
+    arg_parser.add_argument("--id-column", default="ID")
+    arg_parser.add_argument("--threshold", type=float, default=0.5)
+    arg_parser.add_argument(
+        "--max-block",
+        type=int,
+        default=1000,
+        help="larger blocks only link addresses with identical residual words",
+    )
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level="INFO")
+
+    start = time()
+    results = read_results(args.input)
+    write_results(
+        cluster_duplicates(results, args.id_column, args.threshold, args.max_block),
+        args.output,
+    )
+
+    logging.info(f"Take {(time() - start)}seconds")
+
+
+if __name__ == "__main__":
+    main()
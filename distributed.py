@@ -0,0 +1,393 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from time import sleep, time
+from typing import Dict, Iterator, Tuple
+
+import polars as pl
+
+from cli import (
+    add_parser_arguments,
+    check_manifest,
+    chunk_path,
+    detect_format,
+    init_worker,
+    merge_chunks,
+    parser_options,
+    process_chunk,
+    scan_input,
+    stream_chunks,
+)
+from export import ExcelStream
+from prepare import save_reference_index
+
+# shard states, a running shard whose lease expired is claimable again
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    shard INTEGER PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+class ShardQueue:
+    """
+    Work queue of input shards in a SQLite file, shared by every worker
+    process of every node that sees `path`. A worker claims a shard for
+    `lease` seconds and renews the lease while it works, a shard whose
+    worker died is claimed again once its lease expires. Shards claimed
+    `max_attempts` times without completing are left out, see `counts`.
+
+    Example:
+        queue = ShardQueue("./job/queue.sqlite")
+        queue.fill(total=200_000_000, shard_size=1_000_000)
+        shard = queue.claim("node-1:1234", lease=300)
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max_attempts
+        with self.connect() as db:
+            db.execute(SCHEMA)
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        # one short-lived connection per call, so threads and forked
+        # processes never share one. IMMEDIATE takes the write lock up front,
+        # two workers can never claim the same shard
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def fill(self, total: int, shard_size: int):
+        """Splits `total` input rows into shards, once."""
+        with self.connect() as db:
+            if db.execute("SELECT count(*) FROM shards").fetchone()[0]:
+                return
+            db.executemany(
+                "INSERT INTO shards (shard, offset, length) VALUES (?, ?, ?)",
+                [
+                    (i, offset, min(shard_size, total - offset))
+                    for i, offset in enumerate(range(0, total, shard_size))
+                ],
+            )
+
+    def claim(self, worker: str, lease: float) -> Tuple[int, int, int] | None:
+        """(shard, offset, length) of a pending or expired shard, if any."""
+        now = time()
+        with self.connect() as db:
+            row = db.execute(
+                "SELECT shard, offset, length FROM shards"
+                " WHERE (state = ? OR (state = ? AND lease_until < ?))"
+                " AND attempts < ? ORDER BY shard LIMIT 1",
+                (PENDING, RUNNING, now, self.max_attempts),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE shards SET state = ?, worker = ?, lease_until = ?,"
+                " attempts = attempts + 1 WHERE shard = ?",
+                (RUNNING, worker, now + lease, row[0]),
+            )
+        return row
+
+    def renew(self, shard: int, worker: str, lease: float) -> bool:
+        """Extends the lease, False when the shard went to another worker."""
+        with self.connect() as db:
+            return (
+                db.execute(
+                    "UPDATE shards SET lease_until = ?"
+                    " WHERE shard = ? AND worker = ? AND state = ?",
+                    (time() + lease, shard, worker, RUNNING),
+                ).rowcount
+                == 1
+            )
+
+    def complete(self, shard: int):
+        # whichever worker finishes first wins, the shard output of a late
+        # one is the same rows, written by an atomic rename
+        with self.connect() as db:
+            db.execute(
+                "UPDATE shards SET state = ?, lease_until = NULL WHERE shard = ?",
+                (DONE, shard),
+            )
+
+    def counts(self) -> Dict[str, int]:
+        """
+        Shards per state, "failed" for the expired ones out of attempts, which
+        no worker will claim again.
+        """
+        with self.connect() as db:
+            rows = db.execute(
+                "SELECT CASE WHEN state = ? AND attempts >= ? AND lease_until < ?"
+                " THEN 'failed' ELSE state END, count(*) FROM shards GROUP BY 1",
+                (RUNNING, self.max_attempts, time()),
+            ).fetchall()
+        return {PENDING: 0, RUNNING: 0, DONE: 0, "failed": 0, **dict(rows)}
+
+
+@contextmanager
+def heartbeat(queue: ShardQueue, shard: int, worker: str, lease: float):
+    """Renews the lease of `shard` every third of `lease` until the block exits."""
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(lease / 3):
+            if not queue.renew(shard, worker, lease):
+                logging.warning(f"{worker} lost the lease of shard {shard}")
+                return
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def queue_path(work_dir: str) -> str:
+    return os.path.join(work_dir, "queue.sqlite")
+
+
+def read_manifest(work_dir: str) -> dict:
+    with open(os.path.join(work_dir, "manifest.json")) as f:
+        return json.load(f)
+
+
+def read_shard(manifest: dict, offset: int, length: int) -> pl.DataFrame:
+    columns = manifest["columns"]
+    if manifest["format"] == "excel":
+        return pl.read_excel(manifest["input"]).select(columns).slice(offset, length)
+
+    return (
+        scan_input(manifest["input"], manifest["format"])
+        .select(pl.col(columns))
+        .slice(offset, length)
+        .collect()
+    )
+
+
+def init_job(
+    work_dir: str,
+    input_path: str,
+    fmt: str,
+    shard_size: int,
+    columns: Tuple[str, str],
+    options: dict,
+    index: str | None = None,
+):
+    """
+    Writes the manifest every worker reads its input and parser options from,
+    builds the shared reference index if missing and fills the queue.
+    Idempotent for the same job, refused for another one.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    check_manifest(
+        work_dir,
+        {
+            "input": os.path.abspath(input_path),
+            "format": fmt,
+            "shard_size": shard_size,
+            "columns": list(columns),
+            "index": None if index is None else os.path.abspath(index),
+            "parser": options,
+        },
+    )
+    if index is not None and not os.path.exists(index):
+        save_reference_index(index, shorten=options["shorten"])
+
+    if fmt == "excel":
+        total = pl.read_excel(input_path).height
+    else:
+        total = scan_input(input_path, fmt).select(pl.len()).collect().item()
+    ShardQueue(queue_path(work_dir)).fill(total, shard_size)
+    logging.info(f"{total} rows in {-(-total // shard_size)} shards of {work_dir}")
+
+
+def work(
+    work_dir: str,
+    worker: str | None = None,
+    lease: float = 300.0,
+    poll: float = 5.0,
+):
+    """
+    Claims and parses shards into `<work_dir>/chunk-*.parquet` until none is
+    left. While other workers still hold leases, it waits and polls, so the
+    shards of a crashed worker are picked up once their lease expires.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    manifest = read_manifest(work_dir)
+    queue = ShardQueue(queue_path(work_dir))
+    init_worker(manifest["index"], manifest["parser"])
+    columns = tuple(manifest["columns"])
+
+    while True:
+        shard = queue.claim(worker, lease)
+        if shard is None:
+            counts = queue.counts()
+            if not counts[PENDING] and not counts[RUNNING]:
+                break
+            sleep(poll)
+            continue
+
+        i, offset, length = shard
+        start = time()
+        # a shard written before its worker died only needs its state
+        if not os.path.exists(chunk_path(work_dir, i)):
+            with heartbeat(queue, i, worker, lease):
+                process_chunk(
+                    i, read_shard(manifest, offset, length), columns, work_dir
+                )
+        queue.complete(i)
+        logging.info(f"{worker} shard {i} done in {(time() - start)}seconds")
+
+    logging.info(f"{worker} found no shard left: {queue.counts()}")
+
+
+def merge(work_dir: str, output: str):
+    """Combines the shards into `output`, once every shard is done."""
+    counts = ShardQueue(queue_path(work_dir)).counts()
+    if counts[DONE] != sum(counts.values()):
+        raise RuntimeError(f"{work_dir} is not finished: {counts}")
+
+    if output.endswith(".xlsx"):
+        with ExcelStream(output) as stream:
+            stream_chunks(work_dir, stream, 0)
+    else:
+        merge_chunks(work_dir, output)
+    logging.info(f"merged {counts[DONE]} shards into {output}")
+
+
+def run_local(work_dir: str, workers: int, lease: float, poll: float):
+    """Runs `workers` local worker processes to completion."""
+    # polars' thread pool does not survive fork, so workers are spawned
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=work_process, args=(work_dir, lease, poll))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def work_process(work_dir: str, lease: float, poll: float):
+    logging.basicConfig(level="INFO")
+    work(work_dir, lease=lease, poll=poll)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Standardize a file of raw addresses with workers on several "
+        "nodes, sharing a work directory."
+    )
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    init = commands.add_parser(
+        "init", help="split the input into shards and write the job manifest"
+    )
+    run = commands.add_parser(
+        "run", help="init, run local worker processes, then merge"
+    )
+    for command in (init, run):
+        command.add_argument("--input", required=True)
+        command.add_argument(
+            "--format",
+            choices=["excel", "csv", "parquet"],
+            help="default: from extension",
+        )
+        command.add_argument("--shard-size", type=int, default=1_000_000)
+        command.add_argument(
+            "--index",
+            help="reference index directory mapped by every worker, on a "
+            "shared filesystem for several nodes, built on first use",
+        )
+        command.add_argument("--id-column", default="ID")
+        command.add_argument("--addr-column", default="ADDR")
+        add_parser_arguments(command)
+
+    worker = commands.add_parser("work", help="claim and parse shards until done")
+    worker.add_argument("--worker-id", help="default: <hostname>:<pid>")
+    for command in (worker, run):
+        command.add_argument(
+            "--lease",
+            type=float,
+            default=300.0,
+            help="seconds after which the shard of a silent worker is reclaimed",
+        )
+        command.add_argument(
+            "--poll",
+            type=float,
+            default=5.0,
+            help="seconds between checks for expired leases",
+        )
+    run.add_argument("--workers", type=int, default=os.cpu_count())
+
+    merger = commands.add_parser("merge", help="combine the shards into one file")
+    for command in (merger, run):
+        command.add_argument(
+            "--output", required=True, help="csv, parquet or xlsx output"
+        )
+
+    status = commands.add_parser("status", help="print the shards per state")
+    for command in (init, run, worker, merger, status):
+        command.add_argument(
+            "--work-dir",
+            required=True,
+            help="manifest, queue and shard outputs, shared by every node",
+        )
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level="INFO")
+
+    start = time()
+    if args.command in ("init", "run"):
+        init_job(
+            args.work_dir,
+            args.input,
+            args.format or detect_format(args.input),
+            args.shard_size,
+            (args.id_column, args.addr_column),
+            parser_options(args),
+            args.index,
+        )
+    match args.command:
+        case "work":
+            work(args.work_dir, args.worker_id, args.lease, args.poll)
+        case "run":
+            run_local(args.work_dir, args.workers, args.lease, args.poll)
+            merge(args.work_dir, args.output)
+        case "merge":
+            merge(args.work_dir, args.output)
+        case "status":
+            print(ShardQueue(queue_path(args.work_dir)).counts())
+
+    logging.info(f"Take {(time() - start)}seconds")
+
+
+if __name__ == "__main__":
+    main()
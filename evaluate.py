@@ -0,0 +1,165 @@
+import argparse
+import json
+import logging
+from time import time
+from typing import Dict, Sequence
+
+import polars as pl
+
+import inference
+from prepare import address_table, normalize
+
+LEVELS = ["ward", "district", "province"]
+
+
+def normalize_code(col: str) -> pl.Expr:
+    return pl.col(col).cast(pl.String).str.strip_chars().str.strip_chars_start("0")
+
+
+def label_levels(labels: pl.DataFrame) -> list[str]:
+    levels = [level for level in LEVELS if f"{level} code" in labels.columns]
+    if not levels:
+        raise ValueError(
+            f"labels need at least one of {[f'{level} code' for level in LEVELS]}"
+        )
+    return levels
+
+
+def accuracy(
+    result: pl.DataFrame, labels: pl.DataFrame, id_column: str = "ID"
+) -> pl.DataFrame:
+    """
+    Share of labeled addresses whose predicted code matches the label, for
+    every level code column present in `labels`. Addresses without any
+    prediction count as wrong.
+    """
+    levels = label_levels(labels)
+    joined = labels.select(
+        pl.col(id_column).alias("index"),
+        *[normalize_code(f"{level} code").alias(level) for level in levels],
+    ).join(
+        result.select(
+            pl.col("index"),
+            *[
+                normalize_code(f"{level} code").alias(f"{level}_pred")
+                for level in levels
+            ],
+        ),
+        on="index",
+        how="left",
+    )
+
+    return joined.select(
+        pl.len().alias("addresses"),
+        *[
+            pl.col(level).eq_missing(pl.col(f"{level}_pred")).mean().alias(level)
+            for level in levels
+        ],
+    )
+
+
+def calibrate(
+    features: pl.DataFrame,
+    labels: pl.DataFrame,
+    addresses: pl.DataFrame,
+    weights: Dict[str, Dict[str, float]] = inference.DEFAULT_WEIGHTS,
+    id_column: str = "ID",
+    bins: Sequence[float] = inference.MARGIN_BINS,
+) -> Dict:
+    """
+    Fits the confidence calibration used by `inference.candidate_confidence`:
+    the share of fully correct predictions per strategy and margin bin.
+    `addresses` is the `prepare.address_table` the candidates were built on.
+    """
+    levels = label_levels(labels)
+    ranked = inference.rank_candidates(inference.score_features(features, weights))
+    predicted = inference.attach_addresses(
+        inference.best_candidates(ranked), addresses
+    ).join(inference.candidate_margins(ranked), on="index", how="inner")
+
+    observed = (
+        labels.select(
+            pl.col(id_column).alias("index"),
+            *[normalize_code(f"{level} code").alias(level) for level in levels],
+        )
+        .join(
+            predicted.select(
+                pl.col("index", "strategy"),
+                inference.margin_bin(bins),
+                *[
+                    normalize_code(f"{level} code").alias(f"{level}_pred")
+                    for level in levels
+                ],
+            ),
+            on="index",
+            how="inner",
+        )
+        .group_by("strategy", "bin")
+        .agg(
+            pl.all_horizontal(
+                pl.col(level).eq_missing(pl.col(f"{level}_pred")) for level in levels
+            )
+            .mean()
+            .alias("accuracy")
+        )
+    )
+
+    accuracy = {strategy: [None] * (len(bins) + 1) for strategy in inference.STRATEGIES}
+    for strategy, i, value in observed.iter_rows():
+        accuracy[strategy][i] = value
+
+    return {"bins": list(bins), "accuracy": accuracy}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Re-score the cached candidate table against labeled addresses."
+    )
+    parser.add_argument("--candidates", default=inference.CANDIDATES_FILE)
+    parser.add_argument("--labels", default="./dataset/hackathon_result.xlsx")
+    parser.add_argument(
+        "--areas",
+        default="./dataset/param_c06_distilled.parquet",
+        help="official areas the candidates were built on",
+    )
+    parser.add_argument("--weights", help="JSON file of per-strategy weights")
+    parser.add_argument("--id-column", default="ID")
+    parser.add_argument(
+        "--calibrate", help="write the fitted confidence calibration to this JSON"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level="INFO")
+
+    weights = (
+        inference.DEFAULT_WEIGHTS
+        if args.weights is None
+        else inference.load_weights(args.weights)
+    )
+    labels = (
+        pl.read_excel(args.labels)
+        if args.labels.endswith((".xls", ".xlsx"))
+        else pl.read_csv(args.labels)
+    )
+    features = pl.read_parquet(args.candidates)
+    addresses = address_table(pl.read_parquet(args.areas))
+
+    start = time()
+    result = inference.attach_addresses(inference.rescore(features, weights), addresses)
+    scores = accuracy(result, normalize(labels), id_column=args.id_column)
+    end = time()
+
+    print(scores)
+    logging.info(f"Re-scored {features.height} candidates in {(end - start)}seconds")
+
+    if args.calibrate is not None:
+        calibration = calibrate(
+            features, normalize(labels), addresses, weights, id_column=args.id_column
+        )
+        with open(args.calibrate, "w") as f:
+            json.dump(calibration, f, indent=2)
+        logging.info(f"Saved confidence calibration to {args.calibrate}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import logging
+from queue import Queue
+from threading import Thread
+from typing import List
+
+import polars as pl
+
+# rows of an Excel sheet, header included
+EXCEL_MAX_ROWS = 1_048_576
+
+
+class ExcelStream:
+    """
+    Writes frames to an xlsx file in xlsxwriter's constant memory mode, where
+    every row goes to disk as soon as the next one starts, so memory stays
+    flat whatever the number of rows. Frames are queued and written by a
+    background thread, the caller can compute the next one meanwhile. A new
+    sheet, with the header again, starts every `max_rows` rows.
+
+    Example:
+        with ExcelStream("result.xlsx") as stream:
+            for chunk in chunks:
+                stream.write(chunk)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sheet_name: str = "result",
+        max_rows: int = EXCEL_MAX_ROWS,
+        queue_size: int = 2,
+    ):
+        import xlsxwriter
+
+        self.path = path
+        self.sheet_name = sheet_name
+        self.max_rows = max_rows
+        self.workbook = xlsxwriter.Workbook(
+            path, {"constant_memory": True, "nan_inf_to_errors": True}
+        )
+        self.worksheet = None
+        self.columns: List[str] = []
+        self.row = 0
+        self.rows = 0
+        self.error: BaseException | None = None
+
+        # bounded, so a slow disk holds back the producer instead of piling
+        # up frames in memory
+        self.queue: Queue[pl.DataFrame | None] = Queue(maxsize=queue_size)
+        self.thread = Thread(target=self.run, name="excel-writer", daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> "ExcelStream":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, df: pl.DataFrame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(df)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        logging.info(
+            f"wrote {self.rows} rows to {self.path} "
+            f"in {len(self.workbook.worksheets())} sheets"
+        )
+
+    def run(self):
+        closed = False
+        try:
+            while (df := self.queue.get()) is not None:
+                self.write_frame(df)
+            closed = True
+            if self.worksheet is None:
+                self.add_sheet()
+            self.workbook.close()
+        except BaseException as e:
+            self.error = e
+            # keep draining, so the producer never blocks on a dead writer
+            while not closed and self.queue.get() is not None:
+                pass
+
+    def add_sheet(self):
+        number = len(self.workbook.worksheets()) + 1
+        self.worksheet = self.workbook.add_worksheet(
+            self.sheet_name if number == 1 else f"{self.sheet_name} {number}"
+        )
+        self.worksheet.write_row(0, 0, self.columns)
+        self.row = 1
+
+    def write_frame(self, df: pl.DataFrame):
+        if not self.columns:
+            self.columns = df.columns
+
+        for values in df.iter_rows():
+            if self.worksheet is None or self.row == self.max_rows:
+                self.add_sheet()
+            self.worksheet.write_row(self.row, 0, values)
+            self.row += 1
+        self.rows += df.height
+
+
+def write_excel(df: pl.DataFrame, path: str, max_rows: int = EXCEL_MAX_ROWS):
+    """Writes `df` with `ExcelStream`, split over sheets of `max_rows` rows."""
+    with ExcelStream(path, max_rows=max_rows) as stream:
+        stream.write(df)
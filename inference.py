@@ -1,438 +1,631 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence, Tuple
+
 import polars as pl
+import polars.selectors as cs
 
+from dedup import cluster_duplicates, residual_text
+from export import write_excel
+from prepare import AREA_CODES, address_table
 
-def ward_district(
-    official_areas: pl.DataFrame,
-    wards: pl.DataFrame,
-    districts: pl.DataFrame,
-    factor: float = 1.0,
-) -> pl.DataFrame:
-    ward_district_df = wards.join(
-        districts.drop("addr"), on="index", how="inner", suffix="_district"
-    ).rename({"start_idx": "start_idx_ward", "end_idx": "end_idx_ward"})
 
-    filter1 = ward_district_df.filter(
-        pl.col("end_idx_ward") < pl.col("start_idx_district")
+def explode_candidates(
+    hits: pl.DataFrame, level: str, areas: pl.DataFrame
+) -> pl.DataFrame:
+    """
+    One row per hit and candidate code known to `areas`, the `area_lookups`
+    frame of the level, which also brings the parent codes along.
+    """
+    return (
+        hits.explode(f"{level} codes")
+        .rename({f"{level} codes": f"{level} code"})
+        .join(areas, on=f"{level} code", how="inner")
     )
 
-    result = (
-        (
-            official_areas.join(
-                filter1,
-                on=[
-                    pl.col("district code"),
-                    pl.col("district"),
-                    pl.col("ward code"),
-                    pl.col("ward"),
-                ],
-                how="inner",
-            )
-            .with_columns(
-                (
-                    (
-                        (
-                            (
-                                pl.col("end_idx_district")
-                                - pl.col("start_idx_district")
-                                + 1
-                            )
-                            + (pl.col("end_idx_ward") - pl.col("start_idx_ward") + 1)
-                            # distance of each area word also matter
-                            - (pl.col("start_idx_district") - pl.col("end_idx_ward"))
-                            * 0.5
-                        )
-                        * factor
-                    ).alias("score")
-                )
-            )
-            .filter(pl.col("addr").is_not_null())
+
+def hierarchy_check(
+    candidates: pl.DataFrame, parents: List[Tuple[pl.DataFrame, str]]
+) -> pl.DataFrame:
+    """
+    Narrows each ambiguous hit down to the candidates whose parent area was
+    also found after it in the same address. Hits where no candidate passes
+    the check keep all of their candidates.
+    """
+    passed = pl.lit(False)
+    for parent_df, code in parents:
+        present = parent_df.group_by("index", code).agg(
+            pl.col("start_idx").max().alias(f"start_idx {code}")
         )
-        .unique()
-        .select(
-            pl.col(
-                "index",
-                "addr",
-                "ward code",
-                "ward",
-                "district code",
-                "district",
-                "province code",
-                "province",
-                "score",
-                # "end_idx_district",
-                # "start_idx_district",
-                # "start_idx_ward",
-                # "end_idx_ward",
-            )
+        candidates = candidates.join(present, on=["index", code], how="left")
+        passed = passed | (pl.col(f"start_idx {code}") > pl.col("end_idx")).fill_null(
+            False
         )
-        .sort("index")
-    )
 
-    # print(result.filter(pl.col("index").eq(72)))
-    # result.write_csv("ward_district.csv", separator=";")
-    return result
+    return candidates.filter(
+        passed | ~passed.any().over("index", "start_idx", "end_idx")
+    )
 
 
-def ward_province(
+def resolve_candidates(
     official_areas: pl.DataFrame,
-    wards: pl.DataFrame,
-    provinces: pl.DataFrame,
-    factor: float = 2.0,
-) -> pl.DataFrame:
-    ward_district_province_df = wards.join(
-        provinces.drop("addr"), on="index", how="inner", suffix="_province"
-    ).rename({"start_idx": "start_idx_ward", "end_idx": "end_idx_ward"})
-
-    filter1 = ward_district_province_df.filter(
-        pl.col("end_idx_ward") < pl.col("start_idx_province"),
+    match_wards_df: pl.DataFrame,
+    match_districts_df: pl.DataFrame,
+    match_provinces_df: pl.DataFrame,
+    lookups: Dict[str, pl.DataFrame] | None = None,
+) -> Tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    """
+    Turns per-variant hits carrying candidate code lists (see
+    `main.process_address_index`) into the per-area match frames expected by
+    `address_infer`, dropping ambiguous candidates that fail the hierarchy
+    check. `lookups` are the `area_lookups` of `official_areas`, built here
+    when not given.
+    """
+    if lookups is None:
+        lookups = area_lookups(address_table(official_areas))
+
+    provinces = explode_candidates(
+        match_provinces_df, "province", lookups["province code"]
+    )
+    districts = hierarchy_check(
+        explode_candidates(match_districts_df, "district", lookups["district code"]),
+        parents=[(provinces, "province code")],
+    )
+    wards = hierarchy_check(
+        explode_candidates(match_wards_df, "ward", lookups["ward code"]),
+        parents=[(districts, "district code"), (provinces, "province code")],
     )
 
-    result = (
-        (
-            official_areas.join(
-                filter1,
-                on=[
-                    pl.col("ward code"),
-                    pl.col("province code"),
-                    pl.col("ward"),
-                    pl.col("province"),
-                ],
-                how="inner",
-            )
-            .filter(pl.col("start_idx_province").is_not_null())
-            .with_columns(
-                (
-                    (
-                        (
-                            (
-                                pl.col("end_idx_province")
-                                - pl.col("start_idx_province")
-                                + 1
-                            )
-                            + (pl.col("end_idx_ward") - pl.col("start_idx_ward") + 1)
-                        )
-                        * factor
-                    ).alias("score")
-                )
-            )
+    return tuple(
+        df.select(
+            pl.col("index", "addr", f"{level} code", "start_idx", "end_idx"),
+            cs.by_name("start_token", "end_token", require_all=False),
         )
-        .unique()
-        .select(
-            pl.col(
-                "index",
-                "addr",
-                "ward code",
-                "ward",
-                "district code",
-                "district",
-                "province code",
-                "province",
-                "score",
+        for df, level in [
+            (wards, "ward"),
+            (districts, "district"),
+            (provinces, "province"),
+        ]
+    )
+
+
+STRATEGIES = {
+    "ward_district_province": ("ward", "district", "province"),
+    "ward_district": ("ward", "district"),
+    "ward_province": ("ward", "province"),
+    "district_province": ("district", "province"),
+    "province": ("province",),
+    "district": ("district",),
+    "ward": ("ward",),
+}
+
+# score = (sum of matched span lengths - gap_penalty * sum of gaps between
+# consecutive levels) * factor
+DEFAULT_WEIGHTS = {
+    "ward_district_province": {"factor": 3.0, "gap_penalty": 0.5},
+    "ward_district": {"factor": 1.5, "gap_penalty": 0.5},
+    "ward_province": {"factor": 1.5, "gap_penalty": 0.0},
+    "district_province": {"factor": 2.0, "gap_penalty": 0.5},
+    "province": {"factor": 0.5, "gap_penalty": 0.0},
+    "district": {"factor": 0.2, "gap_penalty": 0.0},
+    "ward": {"factor": 0.02, "gap_penalty": 0.0},
+}
+
+FALLBACK_STRATEGIES = [s for s in STRATEGIES if s != "ward_district_province"]
+
+LEVELS = ("ward", "district", "province")
+# span columns measured in characters or in tokens (see `segment.tokenize`)
+POSITIONS = {
+    "char": ("start_idx", "end_idx"),
+    "token": ("start_token", "end_token"),
+}
+GAPS = [("ward", "district"), ("district", "province"), ("ward", "province")]
+# candidates only carry the id of their area, its codes, names and canonical
+# address are gathered for the best ones, see `attach_addresses`
+CANDIDATE_COLUMNS = ["index", "addr", "area id"]
+# character spans of the level hits of a candidate, see `strategy_features`
+SPAN_COLUMNS = [f"{side}_idx_{level}" for level in LEVELS for side in ("start", "end")]
+AREA_COLUMNS = [
+    "index",
+    "addr",
+    "ward code",
+    "ward",
+    "district code",
+    "district",
+    "province code",
+    "province",
+    "address",
+]
+
+
+# confidence is the relative margin between the best and the runner-up
+# candidate, mapped through a table fitted on labeled addresses (see
+# `evaluate.py --calibrate`): {"bins": [...], "accuracy": {strategy: [...]}}
+# where accuracy[i] is the observed accuracy of margins in the i-th bin
+DEFAULT_CALIBRATION = None
+MARGIN_BINS = [0.1, 0.25, 0.5, 0.75, 0.99]
+
+# where the pipeline saves the candidate features for `evaluate.py`
+CANDIDATES_FILE = "candidates.parquet"
+
+
+def load_weights(path: str) -> Dict[str, Dict[str, float]]:
+    with open(path) as f:
+        weights = json.load(f)
+
+    return {
+        strategy: {**DEFAULT_WEIGHTS[strategy], **weights.get(strategy, {})}
+        for strategy in STRATEGIES
+    }
+
+
+def load_calibration(path: str) -> Dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def area_lookups(addresses: pl.DataFrame) -> Dict[str, pl.DataFrame]:
+    """
+    The frames `resolve_candidates` and `strategy_features` look the areas of
+    `addresses` (see `prepare.address_table`) up in, built once per reference
+    list instead of on every call: the parent codes of every ward, district
+    and province code, keyed by that code, and the `area id`s of every
+    combination of the level codes of each strategy, keyed by its name.
+    """
+    lookups = {
+        "ward code": addresses.select(AREA_CODES).unique(
+            "ward code", keep="first", maintain_order=True
+        ),
+        "district code": addresses.select("district code", "province code").unique(
+            "district code", keep="first", maintain_order=True
+        ),
+        "province code": addresses.select("province code").unique(maintain_order=True),
+    }
+    for strategy, levels in STRATEGIES.items():
+        # a candidate without a ward stands for every area of its district or
+        # province, all scored alike: the first two pick the same best one and
+        # runner-up score (see `candidate_margins`) as all of them would
+        lookups[strategy] = (
+            addresses.group_by(
+                [f"{level} code" for level in levels], maintain_order=True
             )
+            .agg(pl.col("area id").sort().head(2))
+            .explode("area id")
         )
-    )
 
-    # print(result)
-    # result.write_csv("ward_province.csv", separator=";")
-    return result
+    return lookups
 
 
-def ward_district_province(
-    official_areas: pl.DataFrame,
-    wards: pl.DataFrame,
-    districts: pl.DataFrame,
-    provinces: pl.DataFrame,
-    factor: float = 3.0,
+def strategy_features(
+    lookups: Dict[str, pl.DataFrame],
+    matches: Dict[str, pl.DataFrame],
+    strategy: str,
+    positions: str = "char",
 ) -> pl.DataFrame:
-    ward_district_province_df = (
-        wards.join(districts.drop("addr"), on="index", how="inner", suffix="_district")
-        .join(provinces.drop("addr"), on="index", how="inner", suffix="_province")
-        .rename({"start_idx": "start_idx_ward", "end_idx": "end_idx_ward"})
-    )
+    """
+    Candidate rows of one strategy: the `area id` (see `area_lookups`) of
+    every combination of its level hits that appear in order in the address
+    and form an official area, with the span
+    length of each level and the gap between consecutive levels, in
+    characters or in tokens depending on `positions`. The character span of
+    each level hit is kept as `start_idx_<level>` and `end_idx_<level>`, for
+    `dedup.residual_text`.
+    """
+    levels = STRATEGIES[strategy]
+    start, end = POSITIONS[positions]
+
+    candidates = None
+    for level in levels:
+        hits = matches[level].select(
+            pl.col("index", "addr", f"{level} code"),
+            pl.col(start).alias(f"start_{level}"),
+            pl.col(end).alias(f"end_{level}"),
+            pl.col("start_idx").alias(f"start_idx_{level}"),
+            pl.col("end_idx").alias(f"end_idx_{level}"),
+        )
+        candidates = (
+            hits
+            if candidates is None
+            else candidates.join(hits.drop("addr"), on="index", how="inner")
+        )
 
-    filter1 = ward_district_province_df.filter(
-        pl.col("end_idx_ward") < pl.col("start_idx_district"),
-        pl.col("end_idx_district") < pl.col("start_idx_province"),
-    )
+    for lhs, rhs in zip(levels, levels[1:]):
+        candidates = candidates.filter(pl.col(f"end_{lhs}") < pl.col(f"start_{rhs}"))
 
-    # print(filter1.filter(pl.col("index").eq(8544)).write_csv("test1.csv"))
-
-    result = (
-        (
-            official_areas.join(
-                filter1,
-                on=[
-                    pl.col("ward code"),
-                    pl.col("ward"),
-                    pl.col("district"),
-                    pl.col("district code"),
-                    pl.col("province"),
-                    pl.col("province code"),
-                ],
-                how="inner",
-            )
-            .filter(pl.col("start_idx_district").is_not_null())
-            # scoring
-            .with_columns(
+    return (
+        lookups[strategy]
+        .join(candidates, on=[f"{level} code" for level in levels], how="inner")
+        .select(
+            pl.col(CANDIDATE_COLUMNS),
+            pl.lit(strategy).alias("strategy"),
+            *[
                 (
-                    (
-                        (
-                            (
-                                pl.col("end_idx_province")
-                                - pl.col("start_idx_province")
-                                + 1
-                            )
-                            + (
-                                pl.col("end_idx_district")
-                                - pl.col("start_idx_district")
-                                + 1
-                            )
-                            + (pl.col("end_idx_ward") - pl.col("start_idx_ward") + 1)
-                            # distance of each area word also matter
-                            - (
-                                pl.col("start_idx_province")
-                                - pl.col("end_idx_district")
-                            )
-                            * 0.5
-                            - (pl.col("start_idx_district") - pl.col("end_idx_ward"))
-                            * 0.5
-                        )
-                        * factor
-                    ).alias("score")
-                )
-            )
+                    pl.col(f"end_{level}") - pl.col(f"start_{level}") + 1
+                    if level in levels
+                    else pl.lit(None, dtype=pl.Int64)
+                ).alias(f"len_{level}")
+                for level in LEVELS
+            ],
+            *[
+                (
+                    pl.col(f"start_{rhs}") - pl.col(f"end_{lhs}")
+                    if (lhs, rhs) in zip(levels, levels[1:])
+                    else pl.lit(None, dtype=pl.Int64)
+                ).alias(f"gap_{lhs}_{rhs}")
+                for lhs, rhs in GAPS
+            ],
+            *[
+                (
+                    pl.col(f"{side}_idx_{level}")
+                    if level in levels
+                    else pl.lit(None, dtype=pl.Int64)
+                ).alias(f"{side}_idx_{level}")
+                for level in LEVELS
+                for side in ("start", "end")
+            ],
         )
         .unique()
-        .select(
-            pl.col(
-                "index",
-                "addr",
-                "ward code",
-                "ward",
-                "district code",
-                "district",
-                "province code",
-                "province",
-                "score",
-            )
-        )
-        .sort("index")
     )
 
-    # result.write_csv("ward_district_province.csv", separator=";")
-    return result
 
-
-def ward(
-    official_areas: pl.DataFrame,
-    wards: pl.DataFrame,
-    factor: float = 2.0,
+def candidate_features(
+    lookups: Dict[str, pl.DataFrame],
+    match_wards_df: pl.DataFrame,
+    match_districts_df: pl.DataFrame,
+    match_provinces_df: pl.DataFrame,
+    parallel: bool = False,
+    positions: str = "char",
+    strategies: Sequence[str] = tuple(STRATEGIES),
 ) -> pl.DataFrame:
-    wards_df = wards.rename({"start_idx": "start_idx_ward", "end_idx": "end_idx_ward"})
-
-    filter1 = wards_df
-
-    result = (
-        (
-            official_areas.join(
-                filter1,
-                on=[
-                    pl.col("ward code"),
-                    pl.col("ward"),
-                ],
-                how="inner",
-            ).filter(pl.col("start_idx_ward").is_not_null())
+    matches = {
+        "ward": match_wards_df,
+        "district": match_districts_df,
+        "province": match_provinces_df,
+    }
+
+    def build(strategy: str) -> pl.DataFrame:
+        return strategy_features(lookups, matches, strategy, positions)
+
+    # the strategies are independent until the concat, and polars releases
+    # the GIL while joining, so plain threads are enough to use every core
+    if parallel:
+        with ThreadPoolExecutor(max_workers=len(strategies)) as pool:
+            results = list(pool.map(build, strategies))
+    else:
+        results = [build(strategy) for strategy in strategies]
+
+    return pl.concat(results)
+
+
+def fallback_bound(
+    frames: Sequence[pl.DataFrame],
+    weights: Dict[str, Dict[str, float]] = DEFAULT_WEIGHTS,
+    positions: str = "char",
+    strategies: Sequence[str] = FALLBACK_STRATEGIES,
+) -> pl.DataFrame:
+    """
+    (index, fallback bound): the most any candidate of `strategies` could
+    score for the address, its factor times the longest hit of each of its
+    levels, since the gaps only take away. Unbounded when a weight is
+    negative.
+    """
+    start, end = POSITIONS[positions]
+    spans = None
+    for level, df in zip(LEVELS, frames):
+        longest = df.group_by("index").agg(
+            (pl.col(end) - pl.col(start) + 1).max().alias(level)
         )
-        .with_columns(
-            (
-                (
-                    (pl.col("end_idx_ward") - pl.col("start_idx_ward") + 1) * factor
-                ).alias("score")
-            )
+        spans = (
+            longest
+            if spans is None
+            else spans.join(longest, on="index", how="full", coalesce=True)
         )
-        .unique()
-        .select(
-            pl.col(
-                "index",
-                "addr",
-                "ward code",
-                "ward",
-                "district code",
-                "district",
-                "province code",
-                "province",
-                "score",
-            )
+
+    bounds = [
+        pl.sum_horizontal(pl.col(level).fill_null(0) for level in STRATEGIES[strategy])
+        * weights[strategy]["factor"]
+        if weights[strategy]["factor"] >= 0 and weights[strategy]["gap_penalty"] >= 0
+        else pl.lit(float("inf"))
+        for strategy in strategies
+    ]
+
+    return spans.select(
+        pl.col("index"),
+        pl.max_horizontal(bounds).cast(pl.Float64).alias("fallback bound"),
+    )
+
+
+def cascade_features(
+    lookups: Dict[str, pl.DataFrame],
+    match_wards_df: pl.DataFrame,
+    match_districts_df: pl.DataFrame,
+    match_provinces_df: pl.DataFrame,
+    weights: Dict[str, Dict[str, float]] = DEFAULT_WEIGHTS,
+    calibration: Dict | None = DEFAULT_CALIBRATION,
+    threshold: float = 0.9,
+    parallel: bool = False,
+    positions: str = "char",
+) -> pl.DataFrame:
+    """
+    Like `candidate_features`, but addresses whose `ward_district_province`
+    candidates alone already reach `threshold` confidence leave the pool, and
+    only the remaining addresses go through the fallback strategies.
+
+    An address only leaves when its best candidate also scores above the
+    `fallback_bound` of the address, so it gets the same best candidate and
+    score as with every strategy. Its candidates carry that bound, which
+    `candidate_margins` takes as the runner-up score when higher: the
+    confidence of an early exit may be lower than with every strategy, never
+    higher.
+    """
+    frames = [match_wards_df, match_districts_df, match_provinces_df]
+    full = strategy_features(
+        lookups,
+        dict(zip(LEVELS, frames)),
+        "ward_district_province",
+        positions,
+    )
+    bound = fallback_bound(frames, weights, positions)
+    resolved = (
+        rescore(full, weights, calibration)
+        .join(bound, on="index", how="inner")
+        .filter(
+            (pl.col("score") > pl.col("fallback bound"))
+            & (pl.col("confidence") >= threshold)
         )
+        .select("index")
+    )
+    logging.info(
+        f"cascade: {resolved.height} addresses resolved by ward_district_province"
     )
 
-    # result.write_csv("district.csv", separator=";")
-    return result
+    fallback = candidate_features(
+        lookups,
+        *(df.join(resolved, on="index", how="anti") for df in frames),
+        parallel=parallel,
+        positions=positions,
+        strategies=FALLBACK_STRATEGIES,
+    )
 
+    # the addresses left in the pool are scored against every strategy, only
+    # the early exits keep their bound
+    full = full.join(
+        bound.join(resolved, on="index", how="semi"),
+        on="index",
+        how="left",
+        maintain_order="left",
+    )
 
-def district(
-    official_areas: pl.DataFrame,
-    districts: pl.DataFrame,
-    factor: float = 2.0,
+    return pl.concat([full, fallback], how="diagonal")
+
+
+def score_features(
+    features: pl.DataFrame, weights: Dict[str, Dict[str, float]] = DEFAULT_WEIGHTS
 ) -> pl.DataFrame:
-    district_df = districts.rename(
-        {"start_idx": "start_idx_district", "end_idx": "end_idx_district"}
+    weights_df = pl.DataFrame(
+        [
+            (strategy, float(weight["factor"]), float(weight["gap_penalty"]))
+            for strategy, weight in weights.items()
+        ],
+        schema=["strategy", "factor", "gap_penalty"],
+        orient="row",
     )
 
-    filter1 = district_df
-
-    result = (
-        (
-            official_areas.join(
-                filter1,
-                on=[
-                    pl.col("district code"),
-                    pl.col("district"),
-                ],
-                how="inner",
-            ).filter(pl.col("start_idx_district").is_not_null())
-        )
+    span = pl.sum_horizontal(pl.col(f"len_{level}").fill_null(0) for level in LEVELS)
+    gap = pl.sum_horizontal(
+        pl.col(f"gap_{lhs}_{rhs}").fill_null(0) for lhs, rhs in GAPS
+    )
+
+    return (
+        features.join(weights_df, on="strategy", how="inner")
         .with_columns(
-            (
-                (
-                    (pl.col("end_idx_district") - pl.col("start_idx_district") + 1)
-                    * factor
-                ).alias("score")
-            )
+            ((span - gap * pl.col("gap_penalty")) * pl.col("factor")).alias("score")
         )
-        .unique()
-        .select(
-            pl.col(
-                "index",
-                "addr",
-                "ward code",
-                "ward",
-                "district code",
-                "district",
-                "province code",
-                "province",
-                "score",
-            )
+        .drop("factor", "gap_penalty")
+    )
+
+
+def rank_candidates(scored: pl.DataFrame) -> pl.DataFrame:
+    # tie-break on the area ids, which follow the codes, so re-scoring the
+    # same features is reproducible, then on the latest spans of an area found
+    # twice, as addresses end with their areas
+    spans = [col for col in SPAN_COLUMNS if col in scored.columns]
+    return scored.sort(
+        ["index", "score", "area id", *spans],
+        descending=[False, True, False, *[True] * len(spans)],
+        nulls_last=True,
+    )
+
+
+def best_candidates(ranked: pl.DataFrame) -> pl.DataFrame:
+    """
+    Best candidate of each address, from `rank_candidates` output, with the
+    spans of its hits when the features carry them.
+    """
+    return ranked.unique("index", keep="first", maintain_order=True).select(
+        pl.col(CANDIDATE_COLUMNS),
+        pl.col("score"),
+        cs.by_name(SPAN_COLUMNS, require_all=False),
+    )
+
+
+def candidate_margins(ranked: pl.DataFrame) -> pl.DataFrame:
+    """
+    Strategy of the best candidate of each address and its relative margin
+    over the best differing candidate, 1.0 when there is no other candidate.
+    The `fallback bound` of the early exits of `cascade_features` stands for
+    the candidates they skipped. Expects `rank_candidates` output.
+    """
+    area = pl.col("area id")
+    differs = area.ne_missing(area.first().over("index"))
+    best = pl.col("score").first()
+    runner_up = pl.col("score").filter(pl.col("differs")).first().fill_null(0.0)
+    if "fallback bound" in ranked.columns:
+        runner_up = pl.max_horizontal(runner_up, pl.col("fallback bound").max())
+
+    return (
+        ranked.with_columns(differs.alias("differs"))
+        .group_by("index", maintain_order=True)
+        .agg(
+            pl.col("strategy").first(),
+            pl.when(best > 0)
+            .then(((best - runner_up) / best).clip(0.0, 1.0))
+            .otherwise(0.0)
+            .alias("margin"),
         )
     )
 
-    # result.write_csv("district.csv", separator=";")
-    return result
 
+def margin_bin(bounds: Sequence[float]) -> pl.Expr:
+    return pl.sum_horizontal(
+        (pl.col("margin") > bound).cast(pl.Int64) for bound in bounds
+    ).alias("bin")
 
-def province(
-    official_areas: pl.DataFrame,
-    provinces: pl.DataFrame,
-    factor: float = 1.0,
+
+def candidate_confidence(
+    margins: pl.DataFrame, calibration: Dict | None = DEFAULT_CALIBRATION
 ) -> pl.DataFrame:
-    province_df = provinces.rename(
-        {"start_idx": "start_idx_province", "end_idx": "end_idx_province"}
+    """
+    Confidence of the best candidate of each address: the observed accuracy of
+    its strategy and margin bin in `calibration`, or the raw margin for bins
+    and strategies the calibration does not cover.
+    """
+    if calibration is None:
+        return margins.select(pl.col("index"), pl.col("margin").alias("confidence"))
+
+    table = pl.DataFrame(
+        [
+            (strategy, i, float(value))
+            for strategy, values in calibration["accuracy"].items()
+            for i, value in enumerate(values)
+            if value is not None
+        ],
+        schema={"strategy": pl.String, "bin": pl.Int64, "accuracy": pl.Float64},
+        orient="row",
     )
 
-    filter1 = province_df
-
-    result = (
-        (
-            official_areas.join(
-                filter1,
-                on=[
-                    pl.col("province code"),
-                    pl.col("province"),
-                ],
-                how="inner",
-            ).filter(pl.col("start_idx_province").is_not_null())
-        )
-        .with_columns(
-            (
-                (
-                    (pl.col("end_idx_province") - pl.col("start_idx_province") + 1)
-                    * factor
-                ).alias("score")
-            )
-        )
-        .unique()
+    return (
+        margins.with_columns(margin_bin(calibration["bins"]))
+        .join(table, on=["strategy", "bin"], how="left")
         .select(
-            pl.col(
-                "index",
-                "addr",
-                "ward code",
-                "ward",
-                "district code",
-                "district",
-                "province code",
-                "province",
-                "score",
-            )
+            pl.col("index"),
+            pl.col("accuracy").fill_null(pl.col("margin")).alias("confidence"),
         )
     )
 
-    # result.write_csv("province.csv", separator=";")
-    return result
-
 
-def district_province(
-    official_areas: pl.DataFrame,
-    districts: pl.DataFrame,
-    provinces: pl.DataFrame,
-    factor: float = 2.0,
+def rescore(
+    features: pl.DataFrame,
+    weights: Dict[str, Dict[str, float]] = DEFAULT_WEIGHTS,
+    calibration: Dict | None = DEFAULT_CALIBRATION,
 ) -> pl.DataFrame:
-    district_province_df = districts.join(
-        provinces.drop("addr"), on="index", how="inner", suffix="_province"
-    ).rename({"start_idx": "start_idx_district", "end_idx": "end_idx_district"})
+    # sorting is the costly part, rank once for both the best and the margins
+    ranked = rank_candidates(score_features(features, weights))
+    confidence = candidate_confidence(candidate_margins(ranked), calibration)
 
-    filter1 = district_province_df.filter(
-        pl.col("end_idx_district") < pl.col("start_idx_province"),
+    return best_candidates(ranked).join(
+        confidence, on="index", how="left", maintain_order="left"
     )
 
-    result = (
-        (
-            official_areas.join(
-                filter1,
-                on=[
-                    pl.col("district code"),
-                    pl.col("district"),
-                    pl.col("province code"),
-                    pl.col("province"),
-                ],
-                how="inner",
-            ).filter(pl.col("start_idx_province").is_not_null())
+
+def attach_addresses(result: pl.DataFrame, addresses: pl.DataFrame) -> pl.DataFrame:
+    """
+    Replaces the `area id` of `result` with the codes, names and canonical
+    address of the area, gathered by position from `addresses` (see
+    `prepare.address_table`) in one pass instead of being joined along.
+    """
+    areas = addresses.select(pl.all().exclude("area id").gather(result["area id"]))
+    columns = result.columns
+    at = columns.index("area id")
+
+    return result.hstack(areas).select(
+        *columns[:at], *areas.columns, *columns[at + 1 :]
+    )
+
+
+def remap_codes(
+    result: pl.DataFrame, code_map: pl.DataFrame, addresses: pl.DataFrame
+) -> pl.DataFrame:
+    """
+    Replaces the historical codes of `result` with the current ones of
+    `code_map` (level, old code, new code), then takes the names, the parents
+    and the address of the remapped areas from the `prepare.address_table` of
+    the current list, so a ward merged into another district also moves to
+    that district. An area that kept its code under another parent is
+    remapped too, onto its current parents.
+    """
+    remapped = pl.lit(False)
+    for i, level in enumerate(LEVELS):
+        code = f"{level} code"
+        columns = [col for lower in LEVELS[i:] for col in (f"{lower} code", lower)]
+        parents = [f"{upper} code" for upper in LEVELS[i + 1 :]]
+        current = addresses.select(
+            pl.col(code),
+            pl.col(columns[1:]).name.suffix("_current"),
+            pl.lit(True).alias("current"),
+        ).unique(code)
+        level_map = code_map.filter(pl.col("level").eq(level)).select(
+            pl.col("old code").alias(code), pl.col("new code")
         )
-        .with_columns(
-            (
-                (
-                    (
-                        (pl.col("end_idx_province") - pl.col("start_idx_province") + 1)
-                        + (
-                            pl.col("end_idx_district")
-                            - pl.col("start_idx_district")
-                            + 1
-                        )
-                        # distance of each area word also matter
-                        - (pl.col("start_idx_province") - pl.col("end_idx_district"))
-                        * 0.5
-                    )
-                    * factor
-                ).alias("score")
-            )
+
+        # the code is current but its parents are not
+        moved = pl.col("current").fill_null(False) & pl.any_horizontal(
+            pl.lit(False),
+            *[
+                pl.col(parent).ne_missing(pl.col(f"{parent}_current"))
+                for parent in parents
+            ],
         )
-        .unique()
-        .select(
-            pl.col(
-                "index",
-                "addr",
-                "ward code",
-                "ward",
-                "district code",
-                "district",
-                "province code",
-                "province",
-                "score",
+        hit = pl.col("new code").is_not_null() | moved
+        result = (
+            result.join(level_map, on=code, how="left", maintain_order="left")
+            .with_columns(pl.coalesce("new code", code).alias(code))
+            .join(current, on=code, how="left", maintain_order="left")
+            .with_columns(
+                (remapped | hit).alias("remapped"),
+                hit.alias("hit"),
+            )
+            .with_columns(
+                pl.when(pl.col("hit"))
+                .then(pl.col(f"{col}_current"))
+                .otherwise(pl.col(col))
+                .alias(col)
+                for col in columns[1:]
+            )
+            .drop(
+                "new code",
+                "current",
+                "hit",
+                *[f"{col}_current" for col in columns[1:]],
             )
         )
+        remapped = pl.col("remapped")
+
+    current = addresses.select(
+        pl.col(AREA_CODES), pl.col("address").alias("address_current")
     )
+    return (
+        result.join(current, on=AREA_CODES, how="left", maintain_order="left")
+        .with_columns(
+            pl.when(pl.col("remapped"))
+            .then(pl.coalesce("address_current", "address"))
+            .otherwise(pl.col("address"))
+            .alias("address")
+        )
+        .drop("address_current")
+    )
+
 
-    # result.write_csv("district_province.csv", separator=";")
-    return result
+def index_partitions(
+    frames: List[pl.DataFrame], partitions: int
+) -> List[Tuple[int, int]]:
+    indexes = pl.concat([df.select("index") for df in frames]).unique().sort("index")
+    size = max(1, -(-indexes.height // partitions))
+    return [
+        (chunk["index"].first(), chunk["index"].last())
+        for chunk in indexes.iter_slices(size)
+    ]
 
 
 def address_infer(
@@ -440,79 +633,100 @@ def address_infer(
     match_wards_df: pl.DataFrame,
     match_districts_df: pl.DataFrame,
     match_provinces_df: pl.DataFrame,
+    parallel: bool = False,
+    partitions: int = 1,
+    weights: Dict[str, Dict[str, float]] = DEFAULT_WEIGHTS,
+    candidates_file: str | None = None,
+    positions: str = "char",
+    cascade: bool = False,
+    cascade_threshold: float = 0.9,
+    calibration: Dict | None = DEFAULT_CALIBRATION,
+    code_map: pl.DataFrame | None = None,
+    current_areas: pl.DataFrame | None = None,
+    excel_file: str | None = None,
+    addresses: pl.DataFrame | None = None,
+    cluster: bool = False,
 ) -> pl.DataFrame:
-    ward_district_province_df = ward_district_province(
-        official_areas=official_areas,
-        wards=match_wards_df,
-        districts=match_districts_df,
-        provinces=match_provinces_df,
-        factor=3.0,
-    )
-
-    ward_district_df = ward_district(
-        official_areas=official_areas,
-        wards=match_wards_df,
-        districts=match_districts_df,
-        factor=1.5,
-    )
+    """
+    Scores every strategy with `weights` and keeps the best candidate per
+    address, with its `confidence` (see `candidate_confidence`).
+
+    With `parallel`, the seven strategies run concurrently. With `partitions`
+    greater than one, the match frames are split into that many `index`
+    ranges which are inferred concurrently instead. The candidate feature
+    table is saved to `candidates_file` when given, so it can be re-scored
+    later without re-matching (see `evaluate.py`). With `positions="token"`, span lengths
+    and gaps are counted in tokens instead of characters. With `cascade`, the
+    fallback strategies only see the addresses the full hierarchy did not
+    resolve with `cascade_threshold` confidence (see `cascade_features`).
+
+    Candidates carry the `area id` of `addresses`, by default the
+    `prepare.address_table` of `official_areas`, and the codes, names and
+    canonical address are attached to the best ones only. When
+    `official_areas` also holds historical areas, `code_map` moves the results
+    onto the codes and names of `current_areas` (see `remap_codes`).
+    The results are also streamed to `excel_file` when given (see
+    `export.ExcelStream`).
+
+    Every result carries the `residual` of its address, what is left once the
+    spans of its ward, district and province are removed (see
+    `dedup.residual_text`). With `cluster`, duplicate addresses are grouped
+    under a `cluster` id (see `dedup.cluster_duplicates`).
+    """
+    frames = [match_wards_df, match_districts_df, match_provinces_df]
+    if addresses is None:
+        addresses = address_table(official_areas)
+    lookups = area_lookups(addresses)
+
+    def build(frames: List[pl.DataFrame], parallel: bool) -> pl.DataFrame:
+        if cascade:
+            return cascade_features(
+                lookups,
+                *frames,
+                weights=weights,
+                calibration=calibration,
+                threshold=cascade_threshold,
+                parallel=parallel,
+                positions=positions,
+            )
+        return candidate_features(
+            lookups, *frames, parallel=parallel, positions=positions
+        )
 
-    ward_province_df = ward_province(
-        official_areas=official_areas,
-        wards=match_wards_df,
-        provinces=match_provinces_df,
-        factor=1.5,
-    )
+    bounds = index_partitions(frames, partitions) if partitions > 1 else []
 
-    district_province_df = district_province(
-        official_areas=official_areas,
-        districts=match_districts_df,
-        provinces=match_provinces_df,
-        factor=2.0,
-    )
+    if len(bounds) > 1:
 
-    province_df = province(
-        official_areas=official_areas,
-        provinces=match_provinces_df,
-        factor=0.5,
-    )
+        def features_range(index_range: Tuple[int, int]) -> pl.DataFrame:
+            in_range = pl.col("index").is_between(*index_range)
+            return build([df.filter(in_range) for df in frames], parallel=False)
 
-    district_df = district(
-        official_areas=official_areas,
-        districts=match_districts_df,
-        factor=0.2,
-    )
+        with ThreadPoolExecutor(max_workers=len(bounds)) as pool:
+            features = pl.concat(pool.map(features_range, bounds))
+    else:
+        features = build(frames, parallel=parallel)
 
-    ward_df = ward(
-        official_areas=official_areas,
-        wards=match_wards_df,
-        factor=0.02,
-    )
+    if candidates_file is not None:
+        features.write_parquet(candidates_file)
 
-    # print(ward_district_province_df.filter(pl.col("index").eq(9)))
-    # print(ward_province_df.filter(pl.col("index").eq(9)))
-    # print(district_province_df.filter(pl.col("index").eq(9)))
+    result_agg = attach_addresses(rescore(features, weights, calibration), addresses)
+    result_agg = result_agg.join(
+        residual_text(result_agg), on="index", how="left", maintain_order="left"
+    ).drop(SPAN_COLUMNS)
+    if code_map is not None:
+        result_agg = remap_codes(
+            result_agg,
+            code_map,
+            address_table(official_areas if current_areas is None else current_areas),
+        )
 
-    # print(district_province_df.filter(pl.col("index").eq(72)).write_csv("test1.csv"))
-    # print(ward_district_df.filter(pl.col("index").eq(72)).write_csv("test1.csv"))
-    combine = pl.concat(
-        [
-            ward_district_province_df,
-            ward_district_df,
-            ward_province_df,
-            district_province_df,
-            province_df,
-            district_df,
-            ward_df,
-        ]
-    )
-    # logging.info(combine)
+    if cluster:
+        result_agg = cluster_duplicates(result_agg)
 
-    result_agg = combine.sort(["index", "score"], descending=[False, True]).unique(
-        "index", keep="first"
-    )
     # logging.info(result_agg)
     result_agg.write_csv("test.csv", separator=";")
-    # result_agg.write_excel("test.xlsx")
+    if excel_file is not None:
+        write_excel(result_agg, excel_file)
 
     return result_agg
 
@@ -524,11 +738,19 @@ def main():
     match_districts_df = pl.read_parquet("./district_match.parquet")
     match_provinces_df = pl.read_parquet("./province_match.parquet")
 
+    match_wards_df, match_districts_df, match_provinces_df = resolve_candidates(
+        official_areas=official_areas,
+        match_wards_df=match_wards_df,
+        match_districts_df=match_districts_df,
+        match_provinces_df=match_provinces_df,
+    )
+
     address_infer(
         official_areas=official_areas,
         match_wards_df=match_wards_df,
         match_districts_df=match_districts_df,
         match_provinces_df=match_provinces_df,
+        candidates_file=CANDIDATES_FILE,
     )
 
 
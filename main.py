@@ -1,11 +1,14 @@
+from __future__ import annotations
+
+import bisect
+import functools
+import itertools
 import logging
 import re
 from time import time
-from typing import List, Sequence, Set, Tuple
+from typing import TYPE_CHECKING, Dict, List, Sequence, Set, Tuple
 
 import polars as pl
-import re2
-from tqdm import tqdm
 
 import inference
 from model import (
@@ -16,13 +19,38 @@ from model import (
     Province,
     RawAddr,
     SubRawAddr,
+    VariantMatch,
     Ward,
 )
-from prepare import normalize, prepare_areas
+from prefilter import split_unresolvable
+from prepare import build_variant_index, normalize, prepare_variants
+from segment import (
+    extract_token_batch,
+    leftmost_longest,
+    ngram_hits,
+    resolve_overlaps,
+    token_positions,
+    token_width,
+    tokenize,
+)
+from trie import VariantTrie, extract_trie_batch
+
+if TYPE_CHECKING:
+    import re2
+
+# re2 budget of each compiled variant program, the default 8MB is too small for
+# the DFA of large alternations and re2 then falls back to the much slower NFA
+RE2_MAX_MEM = 64 << 20
+# states the DFA cache of each program must hold, re2 gives up below 20
+DFA_STATES = 20
 
 
 def match_word_string_multiple(
-    text: str, words: Set[str], case_sensitive: bool = False
+    text: str,
+    words: Set[str],
+    case_sensitive: bool = False,
+    engine: str = "regex",
+    max_mem: int = RE2_MAX_MEM,
 ) -> List[Tuple[int, int]]:
     """
     Checks if any of the given 'words' exist as whole words within 'text' and
@@ -35,6 +63,11 @@ def match_word_string_multiple(
         text (str): The input string to search within. words (List[str]): A list of words to search for.
         case_sensitive (bool): If True, the search is case-sensitive.
                                 If False (default), it ignores case.
+        engine (str): "regex" (default) scans with one re2 alternation.
+                      "token" tokenizes `text` once and probes `words` with
+                      every n-gram of tokens (see `segment.ngram_hits`),
+                      keeping the leftmost-longest non-overlapping hits.
+        max_mem (int): re2 memory budget of the compiled pattern.
 
     Returns:
         List[Tuple[int, int]]: A list of tuples, where each tuple is (start_index, end_index)
@@ -43,6 +76,22 @@ def match_word_string_multiple(
     if not words:
         return []  # No words to search for
 
+    if engine == "token":
+        if not case_sensitive:
+            words = {word.lower() for word in words}
+        hits = ngram_hits(
+            text,
+            tokenize(text),
+            words,
+            token_width(words),
+            case_sensitive=case_sensitive,
+        )
+        return leftmost_longest((start_idx, end_idx) for start_idx, end_idx, _ in hits)
+    if engine != "regex":
+        raise ValueError(f"Unknown engine: {engine}")
+
+    import re2
+
     # Escape each word in the list to treat any special regex characters within it
     # literally. Then join them with '|' (OR) to create a single pattern.
     # Use a non-capturing group (?:...) for the alternation to ensure \b applies
@@ -56,9 +105,13 @@ def match_word_string_multiple(
     if not case_sensitive:
         pattern = "(?i)" + pattern
 
-    # Use re2.finditer() to get an iterator over all matches
+    options = re2.Options()
+    options.max_mem = max_mem
+
+    # Use re2.finditer() to get an iterator over all matches, re2 caches the
+    # compiled pattern by pattern and options
     matches = []
-    for match_object in re2.finditer(pattern, text):
+    for match_object in re2.finditer(pattern, text, options):
         matches.append(
             (match_object.start(), match_object.end() - 1)
         )  # -1 at end to take actual index
@@ -66,6 +119,186 @@ def match_word_string_multiple(
     return matches
 
 
+def variant_options(max_mem: int = RE2_MAX_MEM) -> re2.Options:
+    import re2
+
+    options = re2.Options()
+    options.longest_match = True
+    options.case_sensitive = False
+    options.max_mem = max_mem
+    return options
+
+
+def dfa_memory(program_size: int, dfa_states: int = DFA_STATES) -> int:
+    """
+    Upper bound of the memory a longest-match DFA of a program needs to cache
+    `dfa_states` states, following re2/dfa.cc: the work queues and marks take
+    36 bytes per instruction and a state at most 8 bytes per instruction plus
+    a 257 entries transition table.
+    """
+    return 36 * program_size + dfa_states * (16 + 8 * 257 + 8 * program_size)
+
+
+def dfa_budget(program_size: int, max_mem: int = RE2_MAX_MEM) -> int:
+    """
+    Memory left to the DFA of a program, the tightest one being the reverse
+    DFA: re2 keeps a third of `max_mem` for the reverse program, which stores
+    8 bytes per instruction.
+    """
+    return max_mem // 3 - 8 * program_size
+
+
+def max_program_size(max_mem: int = RE2_MAX_MEM, dfa_states: int = DFA_STATES) -> int:
+    """Largest program whose `dfa_memory` fits its `dfa_budget`."""
+    return (max_mem // 3 - dfa_states * (16 + 8 * 257)) // (36 + 8 + 8 * dfa_states)
+
+
+@functools.lru_cache(maxsize=64)
+def compile_variant_group(
+    words: Tuple[str, ...], max_mem: int, dfa_states: int
+) -> Tuple[re2._Regexp, ...]:
+    """
+    Compiles `words` into as few alternations as fit `max_mem`. The whole group
+    is compiled first; when re2 rejects it or its DFA would not fit, it is
+    split into as many contiguous parts as its program size is larger than
+    `max_program_size`, sorted variants sharing their prefixes, and each part
+    again.
+    Cached, so the programs are shared by every level, parser and reference
+    update holding the same group.
+    """
+    import re2
+
+    try:
+        pattern = re2.compile(
+            r"\b(?:" + "|".join(re.escape(word) for word in words) + r")\b",
+            variant_options(max_mem),
+        )
+        size = max(pattern.programsize, pattern.reverseprogramsize)
+        if dfa_memory(size, dfa_states) <= dfa_budget(size, max_mem):
+            return (pattern,)
+        parts = -(-size // max(max_program_size(max_mem, dfa_states), 1))
+    except re2.error:
+        parts = 2
+
+    if len(words) == 1:
+        raise ValueError(f"Variant {words[0]!r} does not fit in {max_mem} bytes")
+
+    step = -(-len(words) // min(max(parts, 2), len(words)))
+    return tuple(
+        pattern
+        for i in range(0, len(words), step)
+        for pattern in compile_variant_group(words[i : i + step], max_mem, dfa_states)
+    )
+
+
+def compile_variant_patterns(
+    variants: Sequence[str],
+    max_mem: int = RE2_MAX_MEM,
+    dfa_states: int = DFA_STATES,
+) -> List[re2._Regexp]:
+    """
+    Compiles the variants of a whole level into a few leftmost-longest
+    alternations, so a batch is scanned once per pattern instead of once per
+    area. Variants are grouped by word count, so a shorter variant starting at
+    the same position as a longer one (e.g. "tx" and "tx hn") is still found,
+    and each group is partitioned into the fewest programs whose DFA can cache
+    `dfa_states` states within `max_mem` bytes (see `compile_variant_group`).
+    """
+    groups: Dict[int, List[str]] = {}
+    for word in sorted(variants):
+        groups.setdefault(word.count(" "), []).append(word)
+
+    return [
+        pattern
+        for words in groups.values()
+        for pattern in compile_variant_group(tuple(words), max_mem, dfa_states)
+    ]
+
+
+def pattern_report(
+    patterns: Sequence[re2._Regexp], dfa_states: int = DFA_STATES
+) -> pl.DataFrame:
+    """Program sizes and estimated DFA memory of compiled variant patterns."""
+    sizes = [
+        (pattern.programsize, pattern.reverseprogramsize, pattern.options.max_mem)
+        for pattern in patterns
+    ]
+    return pl.DataFrame(
+        {
+            "program size": [size for size, _, _ in sizes],
+            "reverse program size": [size for _, size, _ in sizes],
+            "dfa memory": [
+                dfa_memory(max(size, reverse), dfa_states) for size, reverse, _ in sizes
+            ],
+            "dfa budget": [
+                dfa_budget(max(size, reverse), max_mem)
+                for size, reverse, max_mem in sizes
+            ],
+        },
+        schema={
+            "program size": pl.Int64,
+            "reverse program size": pl.Int64,
+            "dfa memory": pl.Int64,
+            "dfa budget": pl.Int64,
+        },
+    )
+
+
+def log_pattern_report(level: str, patterns: Sequence[re2._Regexp]):
+    report = pattern_report(patterns)
+    logging.info(
+        f"{level}: {len(patterns)} programs, "
+        f"largest program {report['program size'].max()} instructions, "
+        f"DFA memory {report['dfa memory'].sum() >> 20}MB"
+    )
+
+
+def extract_variant_batch(
+    batch: CombinedRawAddr,
+    patterns: Sequence[re2._Regexp],
+    lookup: Dict[str, int],
+) -> List[VariantMatch]:
+    # scan the utf-8 bytes directly: re2 re-encodes str input on every search
+    content = batch.content.encode()
+    encoded_subs = [(sub.raw_addr.content + ";").encode() for sub in batch.schema]
+    starts = list(itertools.accumulate((len(sub) for sub in encoded_subs), initial=0))
+
+    def to_char_idx(i: int, byte_idx: int) -> int:
+        encoded = encoded_subs[i]
+        if len(encoded) == len(batch.schema[i].raw_addr.content) + 1:
+            return byte_idx
+        return len(encoded[:byte_idx].decode(errors="ignore"))
+
+    # a group split over several programs may report a shorter variant of the
+    # same word count at the same start, keep the longest as one program would
+    longest: Dict[Tuple[int, int, int], Tuple[int, str]] = {}
+    for pattern in patterns:
+        match_object = pattern.search(content)
+        while match_object is not None:
+            i = bisect.bisect_right(starts, match_object.start()) - 1
+            start_idx = match_object.start() - starts[i]
+            end_idx = match_object.end() - starts[i]
+
+            # keep overlapping hits: resume right after this hit's start
+            next_pos = match_object.start() + 1
+            variant = match_object.group(0).decode().lower()
+            key = (i, start_idx, variant.count(" "))
+            if end_idx < len(encoded_subs[i]) and end_idx > longest.get(key, (-1,))[0]:
+                longest[key] = (end_idx, variant)
+            match_object = pattern.search(content, next_pos)
+
+    return [
+        VariantMatch(
+            raw_addr=batch.schema[i].raw_addr,
+            variant=variant,
+            row=lookup[variant],
+            start_idx=to_char_idx(i, start_idx),
+            end_idx=to_char_idx(i, end_idx) - 1,
+        )
+        for (i, start_idx, _), (end_idx, variant) in longest.items()
+    ]
+
+
 def extract_batch(
     batch: CombinedRawAddr, matches: List[Tuple[int, int]], area: Area
 ) -> List[AddrMatch]:
@@ -97,8 +330,13 @@ def extract_batch(
 
 
 def batch_address_match_process(
-    batchs: List[CombinedRawAddr], areas: Sequence[Area]
+    batchs: List[CombinedRawAddr], areas: Sequence[Area], engine: str = "regex"
 ) -> List[AddrMatch]:
+    from tqdm import tqdm
+
+    if engine == "token":
+        return batch_token_match_process(batchs, areas)
+
     results = []
     for batch in tqdm(batchs):
         for area in areas:
@@ -111,12 +349,54 @@ def batch_address_match_process(
     return results
 
 
+def batch_token_match_process(
+    batchs: List[CombinedRawAddr], areas: Sequence[Area]
+) -> List[AddrMatch]:
+    """
+    Same matches as `batch_address_match_process`, but each batch is tokenized
+    once and probed against one table of every variant, so the cost grows with
+    the number of tokens instead of the number of areas.
+    """
+    from tqdm import tqdm
+
+    table: Dict[str, List[int]] = {}
+    for i, area in enumerate(areas):
+        for variant in area.variants:
+            table.setdefault(variant.lower(), []).append(i)
+    width = token_width(table)
+
+    results = []
+    for batch in tqdm(batchs):
+        spans: Dict[int, List[Tuple[int, int]]] = {}
+        for start_idx, end_idx, variant in ngram_hits(
+            batch.content, tokenize(batch.content), table, width
+        ):
+            for i in table[variant]:
+                spans.setdefault(i, []).append((start_idx, end_idx))
+
+        for i, area_spans in spans.items():
+            results.extend(
+                extract_batch(
+                    batch=batch, matches=leftmost_longest(area_spans), area=areas[i]
+                )
+            )
+
+    return results
+
+
 def batch_address_match(
-    addrs: Sequence[RawAddr], batch_size: int
+    addrs: Sequence[RawAddr], batch_size: int, progress: bool = True
 ) -> List[CombinedRawAddr]:
+    # tqdm is only imported for interactive runs, it is slow to import
+    steps = range(0, len(addrs), batch_size)
+    if progress:
+        from tqdm import tqdm
+
+        steps = tqdm(steps)
+
     batchs: List[CombinedRawAddr] = []
 
-    for i in tqdm(range(0, len(addrs), batch_size)):
+    for i in steps:
         batch_addr = CombinedRawAddr(content="", schema=[])
         start_idx = 0
         for addr in addrs[i : i + batch_size]:
@@ -202,11 +482,119 @@ def matches_to_df(matches: List[AddrMatch]) -> pl.DataFrame:
             raise
 
 
+def variant_matches_to_df(
+    matches: List[VariantMatch], level: str, level_index: pl.DataFrame
+) -> pl.DataFrame:
+    rows = pl.Series([m.row for m in matches], dtype=pl.UInt32)
+    match_df = pl.DataFrame(
+        {
+            "index": [m.raw_addr.index for m in matches],
+            "addr": [m.raw_addr.content for m in matches],
+            "variant": [m.variant for m in matches],
+            f"{level} codes": level_index["codes"].gather(rows),
+            "ambiguity": level_index["ambiguity"].gather(rows),
+            "start_idx": [m.start_idx for m in matches],
+            "end_idx": [m.end_idx for m in matches],
+        },
+        schema={
+            "index": pl.Int64,
+            "addr": pl.String,
+            "variant": pl.String,
+            f"{level} codes": pl.List(pl.String),
+            "ambiguity": pl.Int64,
+            "start_idx": pl.Int64,
+            "end_idx": pl.Int64,
+        },
+    )
+
+    return match_df.with_columns(token_positions())
+
+
+def process_address_index(
+    addrs: List[RawAddr],
+    variant_index: pl.DataFrame,
+    level: str,
+    file_name: str,
+    batch_size: int = 5000,
+    engine: str = "regex",
+    tail_segments: int | None = None,
+    max_mem: int = RE2_MAX_MEM,
+    overlap: str = "all",
+) -> pl.DataFrame:
+    """
+    Matches `addrs` against every variant of `level` in `variant_index`,
+    emitting one hit per variant occurrence with its list of candidate codes.
+
+    The "regex" engine scans batches with the compiled variant alternations,
+    the "token" engine probes the variants with the n-grams of each address
+    (see `segment.extract_token_matches`) and the "trie" engine walks a
+    compact trie of the variants from every token (see `trie.VariantTrie`),
+    both optionally only in the last `tail_segments` segments. `max_mem` is
+    the re2 budget of each compiled program of the "regex" engine (see
+    `compile_variant_patterns`), and `overlap` the policy applied to
+    overlapping hits before the frame is built (see `segment.resolve_overlaps`).
+    """
+    level_index = variant_index.filter(pl.col("level").eq(level))
+    lookup = {variant: row for row, variant in enumerate(level_index["variant"])}
+
+    logging.info(f"number of addresses: {len(addrs)}")
+    logging.info(f"number of {level} variants: {len(lookup)}")
+
+    from tqdm import tqdm
+
+    results: List[VariantMatch] = []
+    match engine:
+        case "regex":
+            patterns = compile_variant_patterns(list(lookup), max_mem)
+            log_pattern_report(level, patterns)
+            for batch in tqdm(batch_address_match(addrs=addrs, batch_size=batch_size)):
+                results.extend(
+                    extract_variant_batch(batch=batch, patterns=patterns, lookup=lookup)
+                )
+        case "token":
+            width = token_width(lookup)
+            for i in tqdm(range(0, len(addrs), batch_size)):
+                batch = addrs[i : i + batch_size]
+                results.extend(
+                    extract_token_batch(
+                        addrs=batch,
+                        tokens=[tokenize(addr.content) for addr in batch],
+                        lookup=lookup,
+                        width=width,
+                        tail_segments=tail_segments,
+                    )
+                )
+        case "trie":
+            trie = VariantTrie(level_index["variant"])
+            logging.info(f"{level} trie: {len(trie)} nodes, {trie.nbytes()} bytes")
+            for i in tqdm(range(0, len(addrs), batch_size)):
+                batch = addrs[i : i + batch_size]
+                results.extend(
+                    extract_trie_batch(
+                        addrs=batch,
+                        tokens=[tokenize(addr.content) for addr in batch],
+                        trie=trie,
+                        tail_segments=tail_segments,
+                    )
+                )
+        case _:
+            raise ValueError(f"Unknown engine: {engine}")
+
+    results = resolve_overlaps(results, overlap)
+    logging.info(f"number of {level} hits: {len(results)}")
+
+    match_df = variant_matches_to_df(results, level, level_index)
+    match_df.write_parquet(f"{file_name}.parquet")
+
+    return match_df
+
+
 def process_address(
     addrs: List[RawAddr],
     areas: Sequence[Area],
     file_name: str,
     batch_size: int = 5000,
+    engine: str = "regex",
 ) -> pl.DataFrame:
     # addrs: List[RawAddr] = [RawAddr(index=0, content=addr) for addr in sample.ADDR]
     logging.info(f"number of addresses: {len(addrs)}")
@@ -219,7 +607,9 @@ def process_address(
     # pprint(address_match(addrs[49], areas))
 
     batchs = batch_address_match(addrs=addrs, batch_size=batch_size)
-    areas_result.extend(batch_address_match_process(batchs=batchs, areas=areas))
+    areas_result.extend(
+        batch_address_match_process(batchs=batchs, areas=areas, engine=engine)
+    )
 
     # # Prepare arguments for starmap: a list of tuples (addr, areas)
     # # tasks = [(addr, areas) for addr in addrs]
@@ -243,39 +633,58 @@ def main():
     logging.basicConfig(level="INFO")
 
     start = time()
-    wards, districts, provinces = prepare_areas()
-    # print(provinces)
-    areas = provinces
-    logging.info(f"number of areas: {len(areas)}")
+    variant_index = build_variant_index(prepare_variants())
 
     sample_addrs = normalize(pl.read_excel("./dataset/Advance - Sao chép.xlsx"))
-    # print(sample_addrs)
     # sample_addrs = normalize(pl.read_excel("./dataset/sample.xlsx"))
     # sample_addrs = normalize(pl.read_excel("./dataset/hackathon_result.xlsx"))
 
+    sample_addrs, unresolvable = split_unresolvable(sample_addrs, "ADDR")
+    logging.info(f"number of unresolvable addresses: {len(unresolvable)}")
+    unresolvable.select("ID", "ADDR", "reason").write_csv(
+        "unresolvable.csv", separator=";"
+    )
+
     addrs: List[RawAddr] = [
         RawAddr(index=addr["ID"], content=addr["ADDR"])
         for addr in sample_addrs.to_dicts()
     ]
 
-    match_provinces_df = process_address(
-        addrs=addrs, areas=provinces, file_name="province_match"
+    match_provinces_df = process_address_index(
+        addrs=addrs,
+        variant_index=variant_index,
+        level="province",
+        file_name="province_match",
+    )
+    match_districts_df = process_address_index(
+        addrs=addrs,
+        variant_index=variant_index,
+        level="district",
+        file_name="district_match",
     )
-    # print(match_provinces_df.filter(pl.col("index").eq(72)))
-    match_districts_df = process_address(
-        addrs=addrs, areas=districts, file_name="district_match"
+    match_wards_df = process_address_index(
+        addrs=addrs, variant_index=variant_index, level="ward", file_name="ward_match"
     )
-    # print(match_districts_df.filter(pl.col("index").eq(72)))
-    match_wards_df = process_address(addrs=addrs, areas=wards, file_name="ward_match")
-    # print(match_wards_df.filter(pl.col("index").eq(72)))
 
     official_areas = pl.read_parquet("./dataset/param_c06_distilled.parquet")
 
+    match_wards_df, match_districts_df, match_provinces_df = (
+        inference.resolve_candidates(
+            official_areas=official_areas,
+            match_wards_df=match_wards_df,
+            match_districts_df=match_districts_df,
+            match_provinces_df=match_provinces_df,
+        )
+    )
+
     result = inference.address_infer(
         official_areas=official_areas,
         match_wards_df=match_wards_df,
         match_districts_df=match_districts_df,
         match_provinces_df=match_provinces_df,
+        parallel=True,
+        candidates_file=inference.CANDIDATES_FILE,
+        excel_file="test.xlsx",
     )
 
     end = time()
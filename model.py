@@ -50,3 +50,20 @@ class SubRawAddr:
 class CombinedRawAddr:
     content: str
     schema: List[SubRawAddr]
+
+
+@dataclass
+class VariantMatch:
+    raw_addr: RawAddr
+    variant: str
+    row: int  # row of the variant in its level's variant index
+    start_idx: int
+    end_idx: int
+
+
+@dataclass
+class Token:
+    text: str
+    start_idx: int
+    end_idx: int
+    segment: int  # segments are separated by commas, dashes and semicolons
@@ -0,0 +1,57 @@
+from typing import Tuple
+
+import polars as pl
+
+# reasons an input is not worth matching, in the order they are checked
+EMPTY = "empty"
+PUNCTUATION = "punctuation"
+PHONE = "phone"
+SHORT = "short"
+# set by `AddressParser.parse_batch` on inputs that were matched in vain
+UNMATCHED = "unmatched"
+
+REASONS = (EMPTY, PUNCTUATION, PHONE, SHORT, UNMATCHED)
+
+# digits with the usual phone separators, e.g. "0987365371", "+84 913.200.026"
+PHONE_PATTERN = r"^\+?[0-9][0-9 .()\-]*$"
+PHONE_DIGITS = 7
+
+
+def unresolvable_reason(column: str = "addr", min_length: int = 2) -> pl.Expr:
+    """
+    Reason code of the inputs of `column` that cannot hold an address, null
+    for the others: empty, punctuation only, phone number only or fewer than
+    `min_length` letters and digits. Expects `prepare.normalize` output.
+    """
+    addr = pl.col(column)
+    alnum = addr.str.count_matches(r"[^\W_]")
+
+    return (
+        pl.when(addr.is_null() | addr.str.len_chars().eq(0))
+        .then(pl.lit(EMPTY))
+        .when(alnum.eq(0))
+        .then(pl.lit(PUNCTUATION))
+        .when(
+            addr.str.contains(PHONE_PATTERN)
+            & addr.str.count_matches(r"[0-9]").ge(PHONE_DIGITS)
+        )
+        .then(pl.lit(PHONE))
+        .when(alnum.lt(min_length))
+        .then(pl.lit(SHORT))
+        .otherwise(pl.lit(None, dtype=pl.String))
+        .alias("reason")
+    )
+
+
+def split_unresolvable(
+    df: pl.DataFrame, column: str = "addr", min_length: int = 2
+) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Splits `df` into the rows to match and the unresolvable ones, the latter
+    with their `reason`, before any variant scan.
+    """
+    flagged = df.with_columns(unresolvable_reason(column, min_length))
+    return (
+        flagged.filter(pl.col("reason").is_null()).drop("reason"),
+        flagged.filter(pl.col("reason").is_not_null()),
+    )
@@ -1,12 +1,20 @@
-from typing import List, Tuple, Sequence
+from typing import Dict, List, Tuple, Sequence
+import json
 import logging
+import os
 import unicodedata
 
 import polars as pl
-import re2
 
 import variant
-from model import *
+from model import Area, District, Province, Ward
+
+# levels whose variants include the abbreviated forms of their names
+SHORTEN_LEVELS = ("district", "province")
+# curated colloquial and English names, see `read_aliases`
+ALIASES = "./dataset/aliases.csv"
+# codes identifying an area of the official list, see `address_table`
+AREA_CODES = ["ward code", "district code", "province code"]
 
 
 def size_areas(areas: Sequence[Area]) -> int:
@@ -24,7 +32,18 @@ def remove_accents(input_str):
     return "".join([c for c in nfkd_form if not unicodedata.combining(c)])
 
 
+def remove_accents_expr(expr: pl.Expr) -> pl.Expr:
+    return (
+        expr.str.replace_all("đ", "d")
+        .str.replace_all("Đ", "D")
+        .str.normalize("NFKD")
+        .str.replace_all(r"\p{M}", "")
+    )
+
+
 def match_pattern(text: str, pattern: str, ignore_case: bool = True) -> str | None:
+    import re2
+
     match = None
     # re2 uses embedded flags like (?i) for case-insensitivity
     if ignore_case:
@@ -57,8 +76,10 @@ def normalize(df: pl.DataFrame) -> pl.DataFrame:
     )
 
 
-def standadize_areas1() -> pl.DataFrame:
-    df = pl.read_excel("./dataset/Danh sách cấp xã ___25_05_2025.xls")
+def standadize_areas1(
+    path: str = "./dataset/Danh sách cấp xã ___25_05_2025.xls",
+) -> pl.DataFrame:
+    df = pl.read_excel(path)
 
     df = df.drop("Tên Tiếng Anh").rename(
         {
@@ -105,70 +126,276 @@ def standadize_areas1() -> pl.DataFrame:
     return df
 
 
-def prepare_areas() -> Tuple[List[Ward], List[District], List[Province]]:
+def read_aliases(path: str = ALIASES) -> pl.DataFrame:
+    """
+    Curated aliases the variant rules do not produce, e.g. "hcmc" or "dist 1",
+    as a (variant, code, level, priority) table. Empty when `path` is missing.
+    """
+    schema = {
+        "variant": pl.String,
+        "code": pl.String,
+        "level": pl.String,
+        "priority": pl.Int32,
+    }
+    if not os.path.exists(path):
+        logging.warning(f"no alias table at {path}")
+        return pl.DataFrame(schema=schema)
 
-    # print(df.select(pl.col("district level").unique()))
-    # print(df.select(pl.col("district level")).to_series().to_list())
-    # print(df.filter(pl.col("district level").is_null()).select(pl.col("district")))
-    # print(df.select(pl.col("district")))
-    # df = standadize_areas1()
-    # print(df)
-    df = pl.read_parquet("./dataset/param_c06_distilled.parquet")
-    # print(df.filter(pl.col("province code").eq("87")).select(pl.col("ward")).to_series().to_list())
-    # print(df)
-    provinces_df = df.select(
-        pl.col("province", "province level", "province code")
-    ).unique()
-    districts_df = df.select(
-        pl.col("district", "district level", "district code")
-    ).unique()
-    wards_df = df.select(pl.col("ward", "ward level", "ward code")).unique()
-    # print(districts_df.filter(pl.col("district").eq("10")))
-
-    # print(wards_df.select(pl.col("ward level")).unique())
-    # print(districts_df.select(pl.col("district level")).unique())
-    # print(provinces_df.select(pl.col("province level")).unique())
-
-    wards = [
-        Ward(
-            code=row["ward code"],
-            name=row["ward"],
-            level=row["ward level"],
-            variants=variant.generate_variants(
-                name=remove_accents(row["ward"]),
-                level=remove_accents(row["ward level"]),
-                is_shorten=False,
-            ),
+    aliases = pl.read_csv(path, separator=";", schema_overrides={"code": pl.String})
+    return normalize(aliases.rename({"alias": "variant"})).select(
+        pl.col(name).cast(dtype) for name, dtype in schema.items()
+    )
+
+
+def prepare_variants(
+    df: pl.DataFrame | None = None,
+    shorten: Sequence[str] = SHORTEN_LEVELS,
+    aliases: pl.DataFrame | None = None,
+) -> pl.DataFrame:
+    """
+    Flat, deduplicated (variant, code, level, priority) table for every ward,
+    district and province, where level is one of "ward", "district" or
+    "province". The levels in `shorten` also get the abbreviated forms of
+    their names (initials, "x." prefixes, truncated words, see
+    `variant.variant_names`). The `aliases` of the areas of `df`, by default
+    `read_aliases()`, are added with their priority, generated variants have
+    priority 0.
+    """
+    if df is None:
+        df = pl.read_parquet("./dataset/param_c06_distilled.parquet")
+    if aliases is None:
+        aliases = read_aliases()
+
+    frames = []
+    for level in ["ward", "district", "province"]:
+        is_shorten = level in shorten
+        areas = df.select(
+            pl.col(f"{level} code"),
+            remove_accents_expr(pl.col(level)),
+            remove_accents_expr(pl.col(f"{level} level")),
+        ).unique()
+        frames.append(
+            variant.generate_variants_frame(
+                areas,
+                name=level,
+                level=f"{level} level",
+                code=f"{level} code",
+                is_shorten=is_shorten,
+            ).select(
+                pl.col("variant"),
+                pl.col("code"),
+                pl.lit(level).alias("level"),
+                pl.lit(0, dtype=pl.Int32).alias("priority"),
+            )
         )
-        for row in wards_df.iter_rows(named=True)
-    ]
-
-    districts = [
-        District(
-            code=row["district code"],
-            name=row["district"],
-            level=row["district level"],
-            variants=variant.generate_variants(
-                name=remove_accents(row["district"]),
-                level=remove_accents(row["district level"]),
-            ),
+        frames.append(
+            aliases.filter(
+                pl.col("level").eq(level)
+                & pl.col("code").is_in(areas[f"{level} code"].implode())
+            )
         )
-        for row in districts_df.iter_rows(named=True)
-    ]
-    # print(districts)
-
-    provinces = [
-        Province(
-            code=row["province code"],
-            name=row["province"],
-            level=row["province level"],
-            variants=variant.generate_variants(
-                name=remove_accents(row["province"]),
-                level=remove_accents(row["province level"]),
+
+    return pl.concat(frames)
+
+
+def build_variant_index(variants: pl.DataFrame) -> pl.DataFrame:
+    """
+    Inverted index from (level, variant) to the sorted list of area codes that
+    share it. `ambiguity` is the number of candidate codes. When a variant has
+    codes of several priorities, only the highest ones are kept, so a curated
+    alias like "hn" for Hà Nội shadows the Hà Nam initials.
+    """
+    if "priority" in variants.columns:
+        variants = variants.filter(
+            pl.col("priority").eq(pl.col("priority").max().over("level", "variant"))
+        )
+
+    return (
+        variants.group_by("level", "variant")
+        .agg(pl.col("code").unique().sort().alias("codes"))
+        .with_columns(pl.col("codes").list.len().alias("ambiguity"))
+        .sort("level", "variant")
+    )
+
+
+def canonical_name(level: str) -> pl.Expr:
+    """ "Quận Ba Đình" from the "quận" level and "ba đình" name of an area."""
+    prefix = pl.col(f"{level} level")
+    return pl.concat_str(
+        prefix.str.slice(0, 1).str.to_uppercase() + prefix.str.slice(1),
+        pl.col(level).str.to_titlecase(),
+        separator=" ",
+        ignore_nulls=True,
+    )
+
+
+def address_table(official_areas: pl.DataFrame) -> pl.DataFrame:
+    """
+    One row per area of `official_areas`, sorted by codes and numbered by
+    `area id`, with its codes, names and canonical full address, written with
+    the level prefixes and the accented names of the list, e.g. "Phường Phúc
+    Xá, Quận Ba Đình, Thành phố Hà Nội". Ordering ids orders the codes, so
+    inference can carry the id alone and gather the rest at the end.
+    """
+    return (
+        official_areas.unique(AREA_CODES, keep="first", maintain_order=True)
+        .sort(AREA_CODES)
+        .select(
+            pl.int_range(pl.len(), dtype=pl.UInt32).alias("area id"),
+            pl.col(
+                "ward code",
+                "ward",
+                "district code",
+                "district",
+                "province code",
+                "province",
             ),
+            pl.concat_str(
+                [canonical_name(level) for level in ["ward", "district", "province"]],
+                separator=", ",
+                ignore_nulls=True,
+            ).alias("address"),
         )
-        for row in provinces_df.iter_rows(named=True)
-    ]
+    )
+
+
+def save_reference_index(
+    directory: str = "./dataset/reference_index",
+    official_areas: pl.DataFrame | None = None,
+    shorten: Sequence[str] = SHORTEN_LEVELS,
+) -> None:
+    """
+    Writes the official areas, their `address_table` and one variant index
+    per level as uncompressed Arrow IPC files, so worker processes can
+    memory-map a single shared copy with `load_reference_index`.
+    """
+    if official_areas is None:
+        official_areas = pl.read_parquet("./dataset/param_c06_distilled.parquet")
+
+    write_reference_index(
+        directory, official_areas, prepare_variants(official_areas, shorten), shorten
+    )
+
+
+def write_reference_index(
+    directory: str,
+    official_areas: pl.DataFrame,
+    variants: pl.DataFrame,
+    shorten: Sequence[str] = SHORTEN_LEVELS,
+) -> None:
+    """
+    Writes the index of `variants`, a `prepare_variants` table. The table
+    itself, priorities included, and the `shorten` levels it was prepared with
+    are kept along, so `reference.py` can patch it into the same index a full
+    build would give (see `load_index_variants`).
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    def write(df: pl.DataFrame, name: str):
+        # memory mapping needs uncompressed buffers. Files are replaced rather
+        # than overwritten, so processes mapping the old ones keep a valid copy
+        path = os.path.join(directory, f"{name}.arrow")
+        df.write_ipc(path + ".tmp", compression="uncompressed")
+        os.replace(path + ".tmp", path)
+
+    variant_index = build_variant_index(variants)
+    write(official_areas, "areas")
+    write(address_table(official_areas), "addresses")
+    write(variants, "variants")
+    for level in ["ward", "district", "province"]:
+        write(variant_index.filter(pl.col("level").eq(level)), level)
+
+    path = os.path.join(directory, "index.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump({"shorten": list(shorten)}, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def load_reference_index(
+    directory: str = "./dataset/reference_index",
+) -> Tuple[pl.DataFrame, Dict[str, pl.DataFrame]]:
+    def read(name: str) -> pl.DataFrame:
+        return pl.read_ipc(
+            os.path.join(directory, f"{name}.arrow"), memory_map=True, rechunk=False
+        )
+
+    return read("areas"), {
+        level: read(level) for level in ["ward", "district", "province"]
+    }
+
+
+def load_index_variants(
+    directory: str = "./dataset/reference_index",
+) -> Tuple[pl.DataFrame, List[str]]:
+    """
+    The `prepare_variants` table and the shorten levels an index was built
+    from. Indexes written before they were kept fall back to the variants of
+    their level indexes, at priority 0, and the default shorten levels.
+    """
+    path = os.path.join(directory, "variants.arrow")
+    settings = os.path.join(directory, "index.json")
+    if os.path.exists(path) and os.path.exists(settings):
+        with open(settings) as f:
+            shorten = json.load(f)["shorten"]
+        return pl.read_ipc(path), shorten
+
+    logging.warning(
+        f"{directory} has no variant table, the shadowed variants and shorten "
+        "levels of its build are lost"
+    )
+    _, variant_index = load_reference_index(directory)
+    variants = pl.concat(
+        [
+            level_index.select(
+                pl.col("variant"),
+                pl.col("codes").alias("code"),
+                pl.col("level"),
+                pl.lit(0, dtype=pl.Int32).alias("priority"),
+            ).explode("code")
+            for level_index in variant_index.values()
+        ]
+    )
+    return variants, list(SHORTEN_LEVELS)
+
+
+def load_address_table(directory: str = "./dataset/reference_index") -> pl.DataFrame:
+    """`address_table` of an index, built from its areas if it has none."""
+    path = os.path.join(directory, "addresses.arrow")
+    if not os.path.exists(path):
+        return address_table(load_reference_index(directory)[0])
+
+    return pl.read_ipc(path, memory_map=True, rechunk=False)
+
+
+def prepare_areas() -> Tuple[List[Ward], List[District], List[Province]]:
+    df = pl.read_parquet("./dataset/param_c06_distilled.parquet")
+    variants = prepare_variants(df).group_by("level", "code").agg(pl.col("variant"))
+
+    def build(level: str, area_type: type[Area]) -> List[Area]:
+        areas_df = (
+            df.select(pl.col(level, f"{level} level", f"{level} code"))
+            .unique()
+            .join(
+                variants.filter(pl.col("level").eq(level)).drop("level"),
+                left_on=f"{level} code",
+                right_on="code",
+                how="left",
+            )
+        )
+        return [
+            area_type(
+                code=code,
+                name=name,
+                level=area_level,
+                variants=set(area_variants),
+            )
+            for name, area_level, code, area_variants in areas_df.iter_rows()
+        ]
+
+    wards = build("ward", Ward)
+    districts = build("district", District)
+    provinces = build("province", Province)
+
     logging.info(f"number of ward variants: {size_areas(wards)}")
     logging.info(f"number of district variants: {size_areas(districts)}")
     logging.info(f"number of province variants: {size_areas(provinces)}")
@@ -0,0 +1,144 @@
+import glob
+import logging
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, Iterator, List
+
+import polars as pl
+
+ADDRESS_SCHEMA = {
+    "index": pl.Int64,
+    "addr": pl.String,
+    "hits": pl.UInt32,
+    "candidates": pl.UInt32,
+    "seconds": pl.Float64,
+}
+
+
+class Profiler:
+    """
+    Opt-in cost attribution for `AddressParser`. Stage times are summed per
+    stage stack and written in the folded format of flamegraph tools. The
+    time of each stage of a batch is shared out between its addresses by the
+    work they brought to it (see `AddressParser.profile_addresses`), so no
+    address is parsed twice. Only a sample of `sample_rate` of them, plus the
+    `top_n` most expensive ones of each batch, are recorded.
+
+    Example:
+        profiler = Profiler(sample_rate=0.01)
+        parser = AddressParser(profiler=profiler)
+        parser.parse_batch(df["ADDR"])
+        profiler.dump("./profile")
+    """
+
+    def __init__(self, sample_rate: float = 0.01, top_n: int = 20):
+        self.sample_rate = sample_rate
+        self.top_n = top_n
+        self.stages: Dict[str, float] = defaultdict(float)
+        # time of the latest run of each stage, by name
+        self.elapsed: Dict[str, float] = {}
+        self.stack: List[str] = []
+        self.addresses: List[pl.DataFrame] = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        self.stack.append(name)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            self.stages[";".join(self.stack)] += seconds
+            self.elapsed[name] = seconds
+            self.stack.pop()
+
+    def sampled(self) -> pl.Expr:
+        # hashing the index keeps the sample stable across runs and chunks
+        return pl.col("index").hash(seed=0) % 1_000_000 < int(
+            self.sample_rate * 1_000_000
+        )
+
+    def to_record(self, costs: pl.DataFrame) -> pl.DataFrame:
+        """Addresses of a batch to record: the sample and the most expensive."""
+        worst = pl.col("seconds").rank("ordinal", descending=True) <= self.top_n
+        return costs.filter(self.sampled() | worst)
+
+    def record(self, addresses: pl.DataFrame):
+        self.addresses.append(addresses.select(ADDRESS_SCHEMA).cast(ADDRESS_SCHEMA))
+
+    def address_costs(self) -> pl.DataFrame:
+        return pl.concat([pl.DataFrame(schema=ADDRESS_SCHEMA), *self.addresses]).sort(
+            "seconds", "candidates", descending=True, nulls_last=True
+        )
+
+    def top(self, n: int | None = None) -> pl.DataFrame:
+        return self.address_costs().head(n or self.top_n)
+
+    def folded(self) -> List[str]:
+        """
+        One "stage;substage microseconds" line per stage stack, where the time
+        excludes the substages, as expected by flamegraph.pl and speedscope.
+        """
+        children: Dict[str, float] = defaultdict(float)
+        for path, seconds in self.stages.items():
+            if ";" in path:
+                children[path.rsplit(";", 1)[0]] += seconds
+
+        return [
+            f"{path} {max(0, round((seconds - children[path]) * 1e6))}"
+            for path, seconds in sorted(self.stages.items())
+        ]
+
+    def dump(self, prefix: str):
+        """Writes `<prefix>.addresses.parquet` and `<prefix>.folded`."""
+        os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+        self.address_costs().write_parquet(f"{prefix}.addresses.parquet")
+        with open(f"{prefix}.folded", "w") as f:
+            f.writelines(line + "\n" for line in self.folded())
+
+    def reset(self):
+        self.stages.clear()
+        self.elapsed.clear()
+        self.addresses.clear()
+
+
+def merge_profiles(prefixes: List[str], directory: str, top_n: int = 20):
+    """
+    Merges the dumps of several profilers (e.g. one per chunk) into
+    `addresses.parquet`, `top.csv` and `stages.folded` under `directory`.
+    The `index` of an address is local to its dump, so every address also
+    gets the `chunk` it comes from, the name of that dump.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    addresses = pl.concat(
+        [pl.DataFrame(schema={"chunk": pl.String, **ADDRESS_SCHEMA})]
+        + [
+            pl.read_parquet(f"{prefix}.addresses.parquet").select(
+                pl.lit(os.path.basename(prefix)).alias("chunk"), pl.all()
+            )
+            for prefix in prefixes
+        ]
+    ).sort("seconds", "candidates", descending=True, nulls_last=True)
+    addresses.write_parquet(os.path.join(directory, "addresses.parquet"))
+    addresses.head(top_n).write_csv(os.path.join(directory, "top.csv"), separator=";")
+
+    stages: Dict[str, int] = defaultdict(int)
+    for prefix in prefixes:
+        with open(f"{prefix}.folded") as f:
+            for line in f:
+                path, micros = line.rsplit(" ", 1)
+                stages[path] += int(micros)
+    with open(os.path.join(directory, "stages.folded"), "w") as f:
+        f.writelines(f"{path} {micros}\n" for path, micros in sorted(stages.items()))
+
+    logging.info(f"most expensive addresses:\n{addresses.head(top_n)}")
+
+
+def profile_prefixes(directory: str) -> List[str]:
+    return sorted(
+        path.removesuffix(".folded")
+        for path in glob.glob(os.path.join(directory, "*.folded"))
+    )
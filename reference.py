@@ -0,0 +1,458 @@
+import argparse
+import json
+import logging
+import os
+from time import time
+from typing import List, Sequence, Tuple
+
+import polars as pl
+
+from address_parser import AddressParser
+from prepare import (
+    SHORTEN_LEVELS,
+    load_index_variants,
+    load_reference_index,
+    prepare_variants,
+    standadize_areas1,
+    write_reference_index,
+)
+
+LEVELS = ["ward", "district", "province"]
+PARENTS = {
+    "ward": ["district code", "province code"],
+    "district": ["province code"],
+    "province": [],
+}
+# changes after which results pointing at an area may be wrong
+RESULT_CHANGES = ["removed", "renamed", "moved"]
+CODE_MAP_SCHEMA = {"level": pl.String, "old code": pl.String, "new code": pl.String}
+
+
+def read_area_list(path: str) -> pl.DataFrame:
+    """Reads a distilled parquet list, or an Excel list from the ministry."""
+    if path.endswith(".parquet"):
+        return pl.read_parquet(path)
+    return standadize_areas1(path)
+
+
+def level_areas(areas: pl.DataFrame, level: str) -> pl.DataFrame:
+    return areas.select(
+        pl.col(f"{level} code").alias("code"),
+        pl.col(level).alias("name"),
+        pl.col(f"{level} level").alias("prefix"),
+        *PARENTS[level],
+    ).unique("code", keep="first")
+
+
+def diff_areas(old_areas: pl.DataFrame, new_areas: pl.DataFrame) -> pl.DataFrame:
+    """
+    One row per area that differs between two lists, with `change` one of
+    "added", "removed", "renamed" (name or prefix changed, e.g. a "xã" turned
+    into a "phường") or "moved" (same name under another parent).
+    """
+    frames = []
+    for level in LEVELS:
+        old = level_areas(old_areas, level).with_columns(pl.lit(True).alias("old"))
+        new = level_areas(new_areas, level).with_columns(pl.lit(True).alias("new"))
+        joined = old.join(new, on="code", how="full", coalesce=True, suffix="_new")
+
+        renamed = pl.col("name").ne_missing(pl.col("name_new")) | pl.col(
+            "prefix"
+        ).ne_missing(pl.col("prefix_new"))
+        moved = pl.any_horizontal(
+            pl.lit(False),
+            *[
+                pl.col(parent).ne_missing(pl.col(f"{parent}_new"))
+                for parent in PARENTS[level]
+            ],
+        )
+
+        frames.append(
+            joined.select(
+                pl.lit(level).alias("level"),
+                pl.col("code"),
+                pl.when(pl.col("old").is_null())
+                .then(pl.lit("added"))
+                .when(pl.col("new").is_null())
+                .then(pl.lit("removed"))
+                .when(renamed)
+                .then(pl.lit("renamed"))
+                .when(moved)
+                .then(pl.lit("moved"))
+                .alias("change"),
+                pl.col("name").alias("old name"),
+                pl.col("name_new").alias("new name"),
+            ).drop_nulls("change")
+        )
+
+    return pl.concat(frames).sort("level", "code")
+
+
+def changed_codes(diff: pl.DataFrame, level: str, changes: List[str]) -> pl.Series:
+    return diff.filter(pl.col("level").eq(level) & pl.col("change").is_in(changes))[
+        "code"
+    ]
+
+
+def fresh_variants(
+    new_areas: pl.DataFrame,
+    diff: pl.DataFrame,
+    shorten: Sequence[str] = SHORTEN_LEVELS,
+) -> pl.DataFrame:
+    """
+    Variants of the added and renamed areas only, prepared with the `shorten`
+    levels of the index.
+    """
+    frames = []
+    for level in LEVELS:
+        codes = changed_codes(diff, level, ["added", "renamed"])
+        if codes.is_empty():
+            continue
+        frames.append(
+            prepare_variants(
+                new_areas.filter(pl.col(f"{level} code").is_in(codes.implode())),
+                shorten,
+            ).filter(pl.col("level").eq(level) & pl.col("code").is_in(codes.implode()))
+        )
+
+    if not frames:
+        return pl.DataFrame(
+            schema={
+                "variant": pl.String,
+                "code": pl.String,
+                "level": pl.String,
+                "priority": pl.Int32,
+            }
+        )
+    return pl.concat(frames)
+
+
+def patch_variants(
+    variants: pl.DataFrame,
+    new_areas: pl.DataFrame,
+    diff: pl.DataFrame,
+    shorten: Sequence[str] = SHORTEN_LEVELS,
+) -> pl.DataFrame:
+    """
+    Drops the variants of removed and renamed areas from the
+    `prepare.prepare_variants` table of an index and adds those of added and
+    renamed areas, instead of generating the variants of every area again.
+    The priorities are kept, so the index built from the patched table
+    shadows the same variants as a full build.
+    """
+    stale = pl.any_horizontal(
+        pl.col("level").eq(level)
+        & pl.col("code").is_in(
+            changed_codes(diff, level, ["removed", "renamed"]).implode()
+        )
+        for level in LEVELS
+    )
+    fresh = fresh_variants(new_areas, diff, shorten)
+
+    return pl.concat([variants.filter(~stale), fresh.select(variants.columns)])
+
+
+def recoded_areas(
+    old_areas: pl.DataFrame, new_areas: pl.DataFrame, diff: pl.DataFrame
+) -> pl.DataFrame:
+    """
+    Code map of the removed areas that reappear as exactly one added area of
+    the same level, name and prefix. Merges, where several areas become one
+    under a new name, need an explicit map (see `read_code_map`).
+    """
+    frames = []
+    for level in LEVELS:
+
+        def changed(areas: pl.DataFrame, change: str) -> pl.DataFrame:
+            return level_areas(areas, level).filter(
+                pl.col("code").is_in(changed_codes(diff, level, [change]).implode())
+            )
+
+        frames.append(
+            changed(old_areas, "removed")
+            .join(changed(new_areas, "added"), on=["name", "prefix"], how="inner")
+            .filter(pl.len().over("code").eq(1) & pl.len().over("code_right").eq(1))
+            .select(
+                pl.lit(level).alias("level"),
+                pl.col("code").alias("old code"),
+                pl.col("code_right").alias("new code"),
+            )
+        )
+
+    return pl.concat(frames)
+
+
+def read_code_map(path: str) -> pl.DataFrame:
+    """Reads an explicit (level, old code, new code) map, parquet or csv."""
+    df = (
+        pl.read_parquet(path)
+        if path.endswith(".parquet")
+        else pl.read_csv(path, infer_schema=False)
+    )
+    return df.select(
+        pl.col(name).cast(dtype) for name, dtype in CODE_MAP_SCHEMA.items()
+    )
+
+
+def chain_code_maps(maps: Sequence[pl.DataFrame]) -> pl.DataFrame:
+    """
+    Composes the code maps of successive versions, oldest first, so every
+    historical code points straight at its code in the latest list.
+    """
+    result = pl.DataFrame(schema=CODE_MAP_SCHEMA)
+    for code_map in maps:
+        result = (
+            result.join(
+                code_map.rename({"old code": "new code", "new code": "next code"}),
+                on=["level", "new code"],
+                how="left",
+            )
+            .select(
+                pl.col("level", "old code"),
+                pl.coalesce("next code", "new code").alias("new code"),
+            )
+            .vstack(code_map.select(CODE_MAP_SCHEMA))
+            .unique(["level", "old code"], keep="last", maintain_order=True)
+        )
+
+    return result.filter(pl.col("old code").ne(pl.col("new code")))
+
+
+def stale_results(
+    results: pl.DataFrame,
+    diff: pl.DataFrame,
+    new_areas: pl.DataFrame,
+    shorten: Sequence[str] = SHORTEN_LEVELS,
+) -> pl.Expr:
+    """
+    Rows of `results` that may resolve differently under the new list: those
+    pointing at a removed, renamed or moved area, and those whose address
+    contains a variant of an added or renamed area.
+    """
+    stale = pl.any_horizontal(
+        pl.lit(False),
+        *[
+            pl.col(f"{level} code").is_in(
+                changed_codes(diff, level, RESULT_CHANGES).implode()
+            )
+            for level in LEVELS
+            if f"{level} code" in results.columns
+        ],
+    )
+
+    variants = fresh_variants(new_areas, diff, shorten)["variant"].unique().sort()
+    if not variants.is_empty():
+        # (?-u:\b) is an ascii word boundary, like the matchers' re2 patterns
+        pattern = (
+            r"(?i)(?-u:\b)(?:"
+            + "|".join(pl.escape_regex(variant) for variant in variants)
+            + r")(?-u:\b)"
+        )
+        stale = stale | pl.col("addr").str.contains(pattern).fill_null(False)
+
+    return stale
+
+
+def patch_results(
+    results: pl.DataFrame,
+    diff: pl.DataFrame,
+    new_areas: pl.DataFrame,
+    parser: AddressParser,
+    shorten: Sequence[str] = SHORTEN_LEVELS,
+) -> pl.DataFrame:
+    """
+    Re-parses only the stale rows of a result file (see `stale_results`) with
+    a parser over the new list, keeping every other row as is.
+    """
+    results = results.with_row_index("row")
+    affected = results.filter(stale_results(results, diff, new_areas, shorten))
+    logging.info(f"re-parsing {affected.height} of {results.height} results")
+    if affected.is_empty():
+        return results.drop("row")
+
+    parsed = (
+        parser.parse_batch(affected["addr"]).drop("index").with_columns(affected["row"])
+    )
+    common = [col for col in parsed.columns if col in results.columns]
+    parsed = parsed.select(common).cast({col: results.schema[col] for col in common})
+
+    return results.update(parsed, on="row", include_nulls=True).drop("row")
+
+
+def read_results(path: str) -> pl.DataFrame:
+    if path.endswith(".parquet"):
+        return pl.read_parquet(path)
+    return pl.read_csv(path, separator=";", infer_schema=False)
+
+
+def write_results(df: pl.DataFrame, path: str):
+    if path.endswith(".parquet"):
+        df.write_parquet(path + ".tmp")
+    else:
+        df.write_csv(path + ".tmp", separator=";")
+    os.replace(path + ".tmp", path)
+
+
+def record_version(
+    directory: str,
+    version: str,
+    diff: pl.DataFrame,
+    code_map: pl.DataFrame,
+    old_areas: pl.DataFrame,
+):
+    diffs = os.path.join(directory, "diffs")
+    os.makedirs(diffs, exist_ok=True)
+    diff.write_parquet(os.path.join(diffs, f"{version}.parquet"))
+    code_map.write_parquet(os.path.join(diffs, f"{version}.codes.parquet"))
+    old_areas.write_parquet(os.path.join(diffs, f"{version}.areas.parquet"))
+
+    path = os.path.join(directory, "versions.json")
+    versions = []
+    if os.path.exists(path):
+        with open(path) as f:
+            versions = json.load(f)
+    versions.append(
+        {
+            "version": version,
+            **{
+                change: count
+                for change, count in diff.group_by("change").len().iter_rows()
+            },
+            "remapped": code_map.height,
+        }
+    )
+    with open(path, "w") as f:
+        json.dump(versions, f, indent=2)
+
+
+def update_reference(
+    directory: str,
+    new_areas: pl.DataFrame,
+    version: str,
+    results: Sequence[str] = (),
+    code_map: pl.DataFrame | None = None,
+) -> pl.DataFrame:
+    """
+    Moves the reference index in `directory` to a new administrative list:
+    diffs it against the current one, patches the variant indexes, records the
+    diff, the old-to-new code map (`code_map` completed by `recoded_areas`)
+    and the replaced list under `diffs/<version>.*`, then patches every result
+    file.
+    """
+    old_areas, _ = load_reference_index(directory)
+    variants, shorten = load_index_variants(directory)
+
+    diff = diff_areas(old_areas, new_areas)
+    logging.info(f"{version}: {diff.group_by('change').len().rows()}")
+
+    code_map = pl.concat(
+        [
+            pl.DataFrame(schema=CODE_MAP_SCHEMA) if code_map is None else code_map,
+            recoded_areas(old_areas, new_areas, diff),
+        ]
+    ).unique(["level", "old code"], keep="first", maintain_order=True)
+
+    write_reference_index(
+        directory,
+        new_areas,
+        patch_variants(variants, new_areas, diff, shorten),
+        shorten,
+    )
+    record_version(directory, version, diff, code_map, old_areas)
+
+    if results:
+        parser = AddressParser.from_reference_index(directory)
+        for path in results:
+            write_results(
+                patch_results(read_results(path), diff, new_areas, parser, shorten),
+                path,
+            )
+
+    return diff
+
+
+def load_history(directory: str) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Areas of every list replaced in `directory` that the current list no
+    longer holds as is, and the chained code map from their codes to the
+    current ones. Parsing against the current areas plus this history, then
+    remapping (see `inference.remap_codes`), resolves legacy addresses in a
+    single pass:
+
+        history, code_map = load_history("./dataset/reference_index")
+        parser = AddressParser.from_reference_index(
+            history=history, code_map=code_map
+        )
+    """
+    official_areas, _ = load_reference_index(directory)
+
+    path = os.path.join(directory, "versions.json")
+    versions = []
+    if os.path.exists(path):
+        with open(path) as f:
+            versions = [version["version"] for version in json.load(f)]
+
+    def read(version: str, kind: str) -> pl.DataFrame:
+        return pl.read_parquet(
+            os.path.join(directory, "diffs", f"{version}.{kind}.parquet")
+        )
+
+    history = (
+        pl.concat(
+            [
+                read(version, "areas").select(official_areas.columns)
+                for version in versions
+            ]
+        )
+        .unique()
+        .join(official_areas, on=official_areas.columns, how="anti", nulls_equal=True)
+        if versions
+        else official_areas.clear()
+    )
+
+    return history, chain_code_maps([read(version, "codes") for version in versions])
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Move a reference index and its results to a new area list."
+    )
+    arg_parser.add_argument("--index", default="./dataset/reference_index")
+    arg_parser.add_argument(
+        "--new", required=True, help="new area list, distilled parquet or Excel"
+    )
+    arg_parser.add_argument("--version", required=True)
+    arg_parser.add_argument(
+        "--code-map",
+        help="explicit (level, old code, new code) map of this version's "
+        "merges, parquet or csv",
+    )
+    arg_parser.add_argument(
+        "--results",
+        action="append",
+        default=[],
+        help="result file (parquet or ;-separated csv) to patch in place, "
+        "can be repeated",
+    )
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level="INFO")
+
+    start = time()
+    if not os.path.exists(args.index):
+        raise ValueError(f"{args.index} does not exist, build it first")
+
+    diff = update_reference(
+        args.index,
+        read_area_list(args.new),
+        args.version,
+        args.results,
+        code_map=None if args.code_map is None else read_code_map(args.code_map),
+    )
+    print(diff)
+
+    logging.info(f"Take {(time() - start)}seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import re
+from typing import Container, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+import polars as pl
+
+from model import RawAddr, Token, VariantMatch
+
+# re2 word boundaries are ascii only, tokens use the same definition so the
+# token matcher and the regex matcher agree on where a variant starts and ends
+WORD = r"[0-9A-Za-z_]+"
+SEPARATORS = ",;-"
+OVERLAPS = ("all", "maximal", "leftmost-longest")
+
+word_re = re.compile(WORD)
+
+
+def tokenize(content: str) -> List[Token]:
+    """
+    Splits an address into word tokens with their character offsets. Commas,
+    dashes and semicolons between two tokens start a new segment, e.g.
+    "1 ngach 122/41 duong lang,thinh quang,hn" has three segments.
+    """
+    tokens: List[Token] = []
+    segment = 0
+    last_end = 0
+    for match_object in word_re.finditer(content):
+        if tokens and any(
+            c in SEPARATORS for c in content[last_end : match_object.start()]
+        ):
+            segment += 1
+        tokens.append(
+            Token(
+                text=match_object.group(0),
+                start_idx=match_object.start(),
+                end_idx=match_object.end() - 1,
+                segment=segment,
+            )
+        )
+        last_end = match_object.end()
+
+    return tokens
+
+
+def token_width(variants: Iterable[str]) -> int:
+    """Number of tokens of the longest variant, i.e. the largest n-gram to probe."""
+    return max((len(word_re.findall(variant)) for variant in variants), default=0)
+
+
+def tail_start(tokens: Sequence[Token], tail_segments: int | None) -> int:
+    """Index of the first token of the last `tail_segments` segments."""
+    if tail_segments is None or not tokens:
+        return 0
+
+    first_segment = tokens[-1].segment - tail_segments + 1
+    return next(i for i, token in enumerate(tokens) if token.segment >= first_segment)
+
+
+def ngram_hits(
+    content: str,
+    tokens: Sequence[Token],
+    words: Container[str],
+    width: int,
+    first: int = 0,
+    case_sensitive: bool = False,
+) -> Iterator[Tuple[int, int, str]]:
+    """
+    Probes `words` with every n-gram of at most `width` tokens starting at or
+    after token `first`, the key being the exact text between the first and
+    the last token. Yields every (start_idx, end_idx, word) found, overlapping
+    hits included, by start and then by length. `end_idx` is inclusive, as in
+    `main.match_word_string_multiple`.
+    """
+    for i in range(first, len(tokens)):
+        start_idx = tokens[i].start_idx
+        for j in range(i, min(i + width, len(tokens))):
+            end = tokens[j].end_idx + 1
+            keys = [content[start_idx:end]]
+            # a few variants end with punctuation (e.g. "cm'"), they are
+            # followed by a word boundary only if another token comes next
+            if j + 1 < len(tokens) and content[end : tokens[j + 1].start_idx] != " ":
+                keys.append(content[start_idx : tokens[j + 1].start_idx])
+
+            for key in keys:
+                word = key if case_sensitive else key.lower()
+                if word in words:
+                    yield start_idx, start_idx + len(key) - 1, word
+
+
+def leftmost_longest(hits: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Non-overlapping spans, preferring the leftmost then the longest hit."""
+    result: List[Tuple[int, int]] = []
+    for start_idx, end_idx in sorted(hits, key=lambda hit: (hit[0], -hit[1])):
+        if not result or start_idx > result[-1][1]:
+            result.append((start_idx, end_idx))
+
+    return result
+
+
+def resolve_overlaps(
+    matches: Iterable[VariantMatch], overlap: str = "all"
+) -> List[VariantMatch]:
+    """
+    Drops the redundant hits of a level in one sweep over the hits sorted by
+    address, start and decreasing end. "maximal" drops the hits inside a
+    longer one, e.g. "1" inside "q.1", "leftmost-longest" also drops the hits
+    overlapping an earlier kept one, and "all" keeps every hit.
+    """
+    if overlap == "all":
+        return list(matches)
+    if overlap not in OVERLAPS:
+        raise ValueError(f"Unknown overlap policy: {overlap}")
+
+    result: List[VariantMatch] = []
+    index = None
+    reach = -1
+    for match in sorted(
+        matches, key=lambda m: (m.raw_addr.index, m.start_idx, -m.end_idx)
+    ):
+        if match.raw_addr.index != index:
+            index, reach = match.raw_addr.index, -1
+        if overlap == "maximal" and match.end_idx > reach:
+            result.append(match)
+            reach = match.end_idx
+        elif overlap == "leftmost-longest" and match.start_idx > reach:
+            result.append(match)
+            reach = match.end_idx
+
+    return result
+
+
+def extract_token_matches(
+    addr: RawAddr,
+    tokens: Sequence[Token],
+    lookup: Dict[str, int],
+    width: int,
+    tail_segments: int | None = None,
+) -> List[VariantMatch]:
+    """
+    Finds the variants of `lookup` in `addr` with `ngram_hits`. Like the
+    leftmost-longest patterns of `main.compile_variant_patterns`, only the
+    longest hit per start and word count is kept.
+
+    With `tail_segments`, only n-grams starting in the last segments are
+    probed, administrative units are almost always written at the end.
+    """
+    longest: Dict[Tuple[int, int], Tuple[int, str]] = {}
+    for start_idx, end_idx, variant in ngram_hits(
+        addr.content, tokens, lookup, width, tail_start(tokens, tail_segments)
+    ):
+        longest[(start_idx, variant.count(" "))] = (end_idx, variant)
+
+    return [
+        VariantMatch(
+            raw_addr=addr,
+            variant=variant,
+            row=lookup[variant],
+            start_idx=start_idx,
+            end_idx=end_idx,
+        )
+        for (start_idx, _), (end_idx, variant) in longest.items()
+    ]
+
+
+def extract_token_batch(
+    addrs: Sequence[RawAddr],
+    tokens: Sequence[List[Token]],
+    lookup: Dict[str, int],
+    width: int,
+    tail_segments: int | None = None,
+) -> List[VariantMatch]:
+    result = []
+    for addr, addr_tokens in zip(addrs, tokens):
+        result.extend(
+            extract_token_matches(addr, addr_tokens, lookup, width, tail_segments)
+        )
+
+    return result
+
+
+def token_positions() -> List[pl.Expr]:
+    """`start_token` and `end_token` of each hit, from its span over `addr`."""
+    return [
+        pl.col("addr")
+        .str.slice(0, pl.col("start_idx"))
+        .str.count_matches(WORD)
+        .cast(pl.Int64)
+        .alias("start_token"),
+        (
+            pl.col("addr")
+            .str.slice(0, pl.col("end_idx") + 1)
+            .str.count_matches(WORD)
+            .cast(pl.Int64)
+            - 1
+        ).alias("end_token"),
+    ]
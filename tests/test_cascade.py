@@ -0,0 +1,44 @@
+import os
+import unittest
+
+import polars as pl
+
+from address_parser import AddressParser
+
+AREAS = "./dataset/param_c06_distilled.parquet"
+
+ADDRESSES = [
+    # a fallback strategy outscores the only full-hierarchy candidate
+    "truc bach duong nguyen van troi ngo ba dinh ha noi",
+    "phuc xa duong nguyen van troi ngo ba dinh ha noi",
+    # resolved early by the full hierarchy
+    "phuc xa ba dinh ha noi",
+    "06 ngo 107 hong mai hbt hn",
+]
+
+
+@unittest.skipUnless(os.path.exists(AREAS), f"{AREAS} is generated, see README")
+class CascadeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        parser = AddressParser(official_areas=pl.read_parquet(AREAS))
+        cls.full = parser.parse_batch(ADDRESSES)
+        parser.cascade = True
+        cls.cascade = parser.parse_batch(ADDRESSES)
+
+    def test_same_best_candidates(self):
+        columns = ["ward code", "district code", "province code", "score"]
+        self.assertTrue(self.cascade.select(columns).equals(self.full.select(columns)))
+
+    def test_fallback_wins(self):
+        for i in (0, 1):
+            self.assertEqual(self.cascade["ward"][i], self.full["ward"][i])
+            self.assertEqual(self.cascade["score"][i], 24.0)
+            self.assertEqual(self.cascade["confidence"][i], self.full["confidence"][i])
+
+    def test_confidence_never_higher(self):
+        self.assertTrue((self.cascade["confidence"] <= self.full["confidence"]).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
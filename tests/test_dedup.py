@@ -0,0 +1,38 @@
+import os
+import unittest
+
+import polars as pl
+
+from address_parser import AddressParser
+from dedup import cluster_duplicates
+
+AREAS = "./dataset/param_c06_distilled.parquet"
+
+ADDRESSES = [
+    # house numbers equal to the numeric ward or district
+    "12 nguyen trai p.12 q.5 hcm",
+    "5 nguyen trai p.12 q.5 hcm",
+    "nguyen trai p.12 q.5 hcm",
+    "12 nguyen trai, p12, q5, tphcm",
+]
+
+
+@unittest.skipUnless(os.path.exists(AREAS), f"{AREAS} is generated, see README")
+class ResidualTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        parser = AddressParser(official_areas=pl.read_parquet(AREAS))
+        cls.result = cluster_duplicates(parser.parse_batch(ADDRESSES))
+
+    def test_keeps_house_numbers(self):
+        self.assertEqual(
+            self.result["residual"].to_list(),
+            ["12 nguyen trai", "5 nguyen trai", "nguyen trai", "12 nguyen trai"],
+        )
+
+    def test_house_numbers_split_clusters(self):
+        self.assertEqual(self.result["cluster"].to_list(), [0, 1, 2, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
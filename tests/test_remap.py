@@ -0,0 +1,53 @@
+import os
+import unittest
+
+import polars as pl
+
+from address_parser import AddressParser
+
+AREAS = "./dataset/param_c06_distilled.parquet"
+
+
+@unittest.skipUnless(os.path.exists(AREAS), f"{AREAS} is generated, see README")
+class RemapTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        history = pl.read_parquet(AREAS)
+        # phúc xá keeps its code but moves from ba đình to hoàn kiếm
+        moved = pl.col("ward code").eq("00001")
+        current = history.with_columns(
+            pl.when(moved)
+            .then(pl.lit("002"))
+            .otherwise("district code")
+            .alias("district code"),
+            pl.when(moved)
+            .then(pl.lit("hoàn kiếm"))
+            .otherwise("district")
+            .alias("district"),
+        )
+        code_map = pl.DataFrame(
+            schema={"level": pl.String, "old code": pl.String, "new code": pl.String}
+        )
+        parser = AddressParser(
+            official_areas=current, history=history, code_map=code_map
+        )
+        cls.result = parser.parse_batch(
+            ["phuc xa ba dinh ha noi", "truc bach ba dinh ha noi"]
+        )
+
+    def test_moved_area(self):
+        row = self.result.row(0, named=True)
+        self.assertEqual(row["ward code"], "00001")
+        self.assertEqual(row["district code"], "002")
+        self.assertEqual(row["district"], "hoàn kiếm")
+        self.assertIn("Hoàn Kiếm", row["address"])
+        self.assertTrue(row["remapped"])
+
+    def test_unchanged_area(self):
+        row = self.result.row(1, named=True)
+        self.assertEqual(row["district code"], "001")
+        self.assertFalse(row["remapped"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+from array import array
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import polars as pl
+
+from model import RawAddr, Token, VariantMatch
+from segment import tail_start
+
+
+def is_word(c: str) -> bool:
+    # re2 word boundaries are ascii only, see `segment.WORD`
+    return c.isascii() and (c.isalnum() or c == "_")
+
+
+class VariantTrie:
+    """
+    Character trie of the variants of a level in three flat arrays, nodes in
+    breadth-first order so the children of a node are contiguous: `labels`
+    holds the last character of every node, `first` the position of the
+    first child of every node (the children of node i are
+    `first[i]:first[i + 1]`) and `rows` the variant row ending at every node,
+    -1 for inner nodes. Variants sharing a prefix, like the "p.", "p " and
+    "phuong " forms of a ward, share its nodes, so the whole abbreviated ward
+    set takes a few bytes per node instead of a Python string per variant.
+
+    Example:
+        trie = VariantTrie(["hn", "ha noi"])
+        list(trie.walk("ha noi", 0))  # [(5, 1)]
+    """
+
+    def __init__(self, variants: Sequence[str] | pl.Series):
+        prefixes = (
+            pl.DataFrame({"variant": pl.Series(variants, dtype=pl.String)})
+            .with_row_index("row")
+            .with_columns(
+                pl.int_ranges(1, pl.col("variant").str.len_chars() + 1).alias("depth")
+            )
+            .explode("depth")
+            .drop_nulls("depth")
+            .select(
+                pl.col("variant").str.slice(0, pl.col("depth")).alias("prefix"),
+                pl.col("depth"),
+                pl.when(pl.col("depth") == pl.col("variant").str.len_chars())
+                .then(pl.col("row").cast(pl.Int32))
+                .alias("row"),
+            )
+            .group_by("prefix", "depth")
+            .agg(pl.col("row").max())
+            # breadth-first, and by prefix within a depth, so the children of
+            # every node are contiguous and in the order of their parents
+            .sort("depth", "prefix")
+            .with_row_index("node", offset=1)
+        )
+        parents = prefixes.select(
+            pl.col("prefix").str.slice(0, pl.col("depth") - 1).alias("prefix")
+        ).join(
+            prefixes.select("prefix", pl.col("node").alias("parent")),
+            on="prefix",
+            how="left",
+            maintain_order="left",
+        )
+        children = (
+            parents.select(pl.col("parent").fill_null(0))
+            .group_by("parent")
+            .len()
+            .join(
+                pl.DataFrame({"parent": range(prefixes.height + 1)}),
+                on="parent",
+                how="right",
+            )
+            .sort("parent")
+            .select(pl.col("len").fill_null(0))
+        )
+
+        self.labels = "\0" + "".join(prefixes["prefix"].str.slice(-1).to_list())
+        self.first = array("I", [1, *(1 + children["len"].cum_sum()).to_list()])
+        self.rows = array("i", [-1, *prefixes["row"].fill_null(-1).to_list()])
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def nbytes(self) -> int:
+        """Memory of the node arrays."""
+        return (
+            len(self.labels.encode())
+            + self.first.itemsize * len(self.first)
+            + self.rows.itemsize * len(self.rows)
+        )
+
+    def walk(self, text: str, start: int) -> Iterator[Tuple[int, int]]:
+        """(end_idx, row) of every variant spelled from `text[start]` on."""
+        labels, first, rows = self.labels, self.first, self.rows
+        node = 0
+        for i in range(start, len(text)):
+            node = labels.find(text[i], first[node], first[node + 1])
+            if node < 0:
+                return
+            if rows[node] >= 0:
+                yield i, rows[node]
+
+
+def trie_hits(
+    content: str, tokens: Sequence[Token], trie: VariantTrie, first: int = 0
+) -> Iterator[Tuple[int, int, str, int]]:
+    """
+    (start_idx, end_idx, variant, row) of every variant of `trie` starting at
+    a token, from token `first` on, and ending at a word boundary, like the
+    `\\b` delimited patterns of `main.compile_variant_patterns`. `end_idx` is
+    inclusive. Every node is walked at most once per token, so the cost is
+    linear in the input for a bounded variant length.
+    """
+    lowered = content.lower()
+    if len(lowered) != len(content):
+        lowered = content
+
+    for token in tokens[first:]:
+        for end_idx, row in trie.walk(lowered, token.start_idx):
+            after = lowered[end_idx + 1] if end_idx + 1 < len(lowered) else " "
+            if is_word(lowered[end_idx]) != is_word(after):
+                yield (
+                    token.start_idx,
+                    end_idx,
+                    lowered[token.start_idx : end_idx + 1],
+                    row,
+                )
+
+
+def extract_trie_matches(
+    addr: RawAddr,
+    tokens: Sequence[Token],
+    trie: VariantTrie,
+    tail_segments: int | None = None,
+) -> List[VariantMatch]:
+    """
+    Finds the variants of `trie` in `addr`, keeping the longest hit per start
+    and word count as `segment.extract_token_matches` does.
+    """
+    longest: Dict[Tuple[int, int], Tuple[int, str, int]] = {}
+    for start_idx, end_idx, variant, row in trie_hits(
+        addr.content, tokens, trie, tail_start(tokens, tail_segments)
+    ):
+        longest[(start_idx, variant.count(" "))] = (end_idx, variant, row)
+
+    return [
+        VariantMatch(
+            raw_addr=addr,
+            variant=variant,
+            row=row,
+            start_idx=start_idx,
+            end_idx=end_idx,
+        )
+        for (start_idx, _), (end_idx, variant, row) in longest.items()
+    ]
+
+
+def extract_trie_batch(
+    addrs: Sequence[RawAddr],
+    tokens: Sequence[List[Token]],
+    trie: VariantTrie,
+    tail_segments: int | None = None,
+) -> List[VariantMatch]:
+    result = []
+    for addr, addr_tokens in zip(addrs, tokens):
+        result.extend(extract_trie_matches(addr, addr_tokens, trie, tail_segments))
+
+    return result
@@ -2,6 +2,19 @@ import itertools
 import logging
 from typing import Set
 
+import polars as pl
+
+LEVELS = [
+    "phuong",
+    "xa",
+    "thi tran",
+    "quan",
+    "huyen",
+    "thi xa",
+    "thanh pho",
+    "tinh",
+]
+
 
 def variant_names(name: str, is_shorten: bool = True) -> Set[str]:
     words = name.lower().split(" ")
@@ -111,6 +124,102 @@ def generate_variants(name: str, level: str, is_shorten: bool = True) -> Set[str
     return variants
 
 
+def level_prefixes() -> pl.DataFrame:
+    return pl.DataFrame(
+        [
+            (level, prefix)
+            for level in LEVELS
+            for prefix in sorted(variant_level(level))
+        ],
+        schema=["level", "prefix"],
+        orient="row",
+    )
+
+
+def variant_names_expr(name: pl.Expr, is_shorten: bool = True) -> pl.Expr:
+    """Vectorized `variant_names`: a list column of name variants per row."""
+    words = name.str.to_lowercase().str.split(" ")
+    count = words.list.len()
+    w0 = words.list.get(0, null_on_oob=True)
+    w1 = words.list.get(1, null_on_oob=True)
+    w2 = words.list.get(2, null_on_oob=True)
+
+    def when_count(n: int, expr: pl.Expr) -> pl.Expr:
+        return pl.when(count == n).then(expr)
+
+    result = [
+        name,
+        when_count(1, w0),
+        when_count(2, w0 + w1),
+        when_count(2, w0 + " " + w1),
+        when_count(3, w0 + " " + w1 + " " + w2),
+    ]
+
+    if is_shorten:
+        result.extend(
+            [
+                when_count(2, w0.str.slice(0, 1) + w1.str.slice(0, 1)),
+                when_count(2, w0.str.slice(0, 1) + w1),
+                when_count(2, w0.str.slice(0, 1) + w1.str.slice(0, 2)),
+                when_count(2, w0.str.slice(0, 1) + "." + w1),
+                when_count(2, w0.str.slice(0, 1) + "." + w1.str.slice(0, 2)),
+                pl.when((count == 2) & (w0.str.len_chars() > 2)).then(
+                    w0.str.slice(0, 2) + "." + w1
+                ),
+                pl.when((count == 2) & (w0.str.len_chars() > 2)).then(
+                    w0.str.slice(0, 2) + " " + w1
+                ),
+                when_count(
+                    3, w0.str.slice(0, 1) + w1.str.slice(0, 1) + w2.str.slice(0, 1)
+                ),
+            ]
+        )
+
+    # special cases
+    is_tu_liem = name.is_in(["bac tu liem", "nam tu liem"])
+    result.append(pl.when(is_tu_liem).then(pl.lit("tu liem")))
+    result.append(pl.when(is_tu_liem).then(pl.lit("tl")))
+
+    return pl.concat_list(result)
+
+
+def generate_variants_frame(
+    areas: pl.DataFrame,
+    name: str,
+    level: str,
+    code: str,
+    is_shorten: bool = True,
+) -> pl.DataFrame:
+    """
+    Batch version of `generate_variants` over a whole areas frame.
+
+    `name` and `level` columns must already be unaccented. Returns a flat,
+    deduplicated (code, variant) frame.
+    """
+    for bad_name in areas.filter(pl.col(name).str.split(" ").list.len() > 5)[
+        name
+    ].to_list():
+        logging.error(ValueError(bad_name))
+
+    names = (
+        areas.select(
+            pl.col(code).alias("code"),
+            pl.col(level).alias("level"),
+            variant_names_expr(pl.col(name), is_shorten).alias("variant"),
+        )
+        .explode("variant")
+        .drop_nulls("variant")
+        .unique()
+    )
+
+    prefixed = names.join(level_prefixes(), on="level", how="inner").select(
+        pl.col("code"),
+        (pl.col("prefix") + pl.col("variant")).alias("variant"),
+    )
+
+    return pl.concat([names.drop("level"), prefixed]).unique()
+
+
 def main():
     # Example usage
     base = "2"